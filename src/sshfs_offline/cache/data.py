@@ -1,4 +1,5 @@
 
+from concurrent.futures import ThreadPoolExecutor
 import math
 from pathlib import Path
 import os
@@ -6,7 +7,9 @@ from sshfs_offline import log
 
 from logging import getLogger
 import queue
+import shutil
 import threading
+import time
 
 from sshfs_offline import metrics
 from sshfs_offline import sftp
@@ -14,25 +17,56 @@ from sshfs_offline import sftp
 from errno import ENOENT
 
 from sshfs_offline.cache import metadata
+from sshfs_offline.cache.extents import Extents
+from sshfs_offline.cache.memory import Memory
 
 from fuse import FuseOSError
 
+class _Fetch:
+    '''
+    A range fetch in flight.  Other readers of the range wait for it instead of fetching the range again.
+    '''
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.done = threading.Event()
+        self.stale = False # set when the file is changed or deleted while fetching
+
 class Data:
     '''
-    On demand data file cache.   The files are cached in 64k chunks (blocks).  Only the blocks of the file that is read by
-    the user are cached.  Subsequent reads for the same data block are very fast.
+    On demand data file cache.  Only the ranges of the file that are read by the user are fetched, into a sparse
+    data file, and the cached ranges are tracked as extents.  Subsequent reads of the same range are very fast.
     '''
     DATA_DIR = os.path.join(Path.home(), '.sshfs-offline', 'data') 
-    BLOCK_SIZE = sftp.BLOCK_SIZE  
- 
-    def __init__(self, host: str, basedir: str):
+    BLOCK_SIZE = sftp.BLOCK_SIZE
+    WHOLE_FILE_SIZE = 1024 * 1024 # files up to this size are fetched whole
+    MAX_PREFETCH_SIZE = 16 * 1024 * 1024
+    STRIPES = 4
+    STRIPE_MIN_SIZE = 64 * 1024 * 1024 # files of at least this size are fetched with parallel stripes
+    LOCK_STRIPES = 256
+
+    def __init__(self, host: str, basedir: str, blockSize: int=BLOCK_SIZE, stripes: int=STRIPES, stripeMinSize: int=STRIPE_MIN_SIZE,
+                 ramSize: int=0):
         self.log = getLogger(log.DATA)
+        self.blockSize = blockSize
+        self.memory: Memory = Memory(ramSize) if ramSize > 0 else None # RAM tier of hot blocks
+        self.stripes = stripes
+        self.stripeMinSize = stripeMinSize
+        self.stripePool: ThreadPoolExecutor = None
+        self.lock = threading.Lock()
             
         # make data cache directory ~/.sshfs-offline/data
         self.dataDir = os.path.join(Data.DATA_DIR, host, os.path.splitroot(basedir)[-1])
         if not os.path.exists(self.dataDir):
             os.makedirs(self.dataDir) 
 
+        # Data file and extents updates are serialized per file.  Files are hashed to a fixed set of locks.
+        self.fileLocks = [threading.RLock() for i in range(Data.LOCK_STRIPES)]
+        # Writes and truncates of a file are serialized from the remote update to the data file update, so the data
+        # file ends up with the same content as the remote file.
+        self.writeLocks = [threading.Lock() for i in range(Data.LOCK_STRIPES)]
+        self.inflight: dict[str, list[_Fetch]] = dict()
+
         self.fileReaderQueue = queue.Queue()
 
         threading.Thread(target=self.fileReaderThread).start()        
@@ -41,14 +75,23 @@ class Data:
         #p = path.replace('/','%').replace('\\', '%')
         return os.path.join(self.dataDir, path[1:]) 
       
+    def size(self, path: str) -> int | None:
+        '''
+        Size of the cached data file, or None when the file is not cached.
+        '''
+        try:
+            return os.path.getsize(self._dataPath(path))
+        except OSError:
+            return None
+
     def statvfs(self, path: str):
         self.log.debug('statvfs: %s', path)              
         dataPath = self._dataPath(path)
        
         if os.path.exists(dataPath):
             dic = os.statvfs(dataPath) 
-            dic['f_bsize'] = sftp.BLOCK_SIZE
-            dic['f_frsize'] = sftp.BLOCK_SIZE
+            dic['f_bsize'] = self.blockSize
+            dic['f_frsize'] = self.blockSize
             return dic
                     
     def deleteStaleFile(self, path, mtime: float=None ): 
@@ -58,110 +101,415 @@ class Data:
         
         dataPath = self._dataPath(path)        
      
-        if os.path.exists(dataPath) and os.path.isfile(path):                               
-            if (mtime == None or os.lstat(dataPath).st_ctime < mtime):
-                self.log.debug('deleteStaleFile: deleting %s', path) 
-                metrics.counts.incr('deleteStaleFile')
-                os.unlink(dataPath)  
-                metadata.cache.deleteMetadata(path, [metadata.Metadata.BLOCKMAP])             
+        with self._fileLock(path):
+            if mtime == None:
+                self.invalidateMemory(path) # deleted, a new file at the path must not read the old blocks
+            if os.path.isfile(dataPath):
+                if (mtime == None or os.lstat(dataPath).st_ctime < mtime):
+                    self.log.debug('deleteStaleFile: deleting %s', path)
+                    metrics.counts.incr('deleteStaleFile')
+                    self._markStale(path)
+                    os.unlink(dataPath)
+                    metadata.cache.deleteMetadata(path, [metadata.Metadata.EXTENTS, metadata.Metadata.BLOCKMAP])
+
+    def create(self, path: str):
+        '''
+        Start an empty cached data file for a file that was just created on the remote host.
+        '''
+        self.log.debug('create: %s', path)
+        if not sftp.manager.isConnected():
+            return
+
+        dataPath = self._dataPath(path)
+        with self._fileLock(path):
+            self._markStale(path)
+            os.makedirs(os.path.dirname(dataPath), exist_ok=True)
+            with open(dataPath, 'wb'):
+                pass
+            metadata.cache.deleteMetadata(path, [metadata.Metadata.EXTENTS, metadata.Metadata.BLOCKMAP])
+
+    def write(self, path: str, buf: bytes, offset: int, fileSize: int):
+        '''
+        Write through to the cached data file, and add the written range to the cached extents.
+        '''
+        self.log.debug('write: %s size=%d offset=%d', path, len(buf), offset)
+        if not sftp.manager.isConnected():
+            return
+
+        dataPath = self._dataPath(path)
+        with self._fileLock(path):
+            if not os.path.isfile(dataPath):
+                return # not cached
+            self._markStale(path) # in-flight fetches have data from before the write
+            extents = self._resize(path, dataPath, fileSize)
+            with open(dataPath, 'rb+') as file:
+                file.seek(offset)
+                file.write(buf)
+            extents.add(offset, min(offset + len(buf), fileSize))
+            metadata.cache.extents_save(path, extents)
+            metrics.counts.incr('write_through')
+
+    def truncate(self, path: str, length: int):
+        '''
+        Resize the cached data file and its extents in place.
+        '''
+        self.log.debug('truncate: %s %d', path, length)
+        if not sftp.manager.isConnected():
+            return
+
+        dataPath = self._dataPath(path)
+        with self._fileLock(path):
+            if not os.path.isfile(dataPath):
+                return # not cached
+            self._markStale(path)
+            metadata.cache.extents_save(path, self._resize(path, dataPath, length))
+
+    def touch(self, path: str):
+        '''
+        Update the ctime of the cached data file, so the file is not considered stale after a remote utime.
+        '''
+        dataPath = self._dataPath(path)
+        with self._fileLock(path):
+            if os.path.isfile(dataPath):
+                os.utime(dataPath)
+
+    def rename(self, old: str, new: str):
+        '''
+        Move the cached data file, or the cached directory tree, of old to new.
+        '''
+        self.log.debug('rename: %s %s', old, new)
+        if not sftp.manager.isConnected():
+            return
+
+        oldPath = self._dataPath(old)
+        newPath = self._dataPath(new)
+        locks = sorted({self._fileLock(old), self._fileLock(new)}, key=id)
+        for lock in locks:
+            lock.acquire()
+        try:
+            self._markStale(old, tree=True)
+            self._markStale(new, tree=True)
+            if os.path.isdir(newPath) and not os.path.islink(newPath):
+                shutil.rmtree(newPath)
+            elif os.path.lexists(newPath):
+                os.unlink(newPath)
+            if os.path.lexists(oldPath):
+                metrics.counts.incr('rename_data')
+                os.makedirs(os.path.dirname(newPath), exist_ok=True)
+                os.rename(oldPath, newPath)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
 
     def read(self, path, size, offset, fh):  
         #self.log.debug('read: %s input: size=%d offset=%d fd=%d', path, size, offset, fh)
+        if self.memory != None:
+            return self._readMemory(path, size, offset)
+        buf = self.fetch(path, size, offset, read=True)
+        #self.log.debug('read: %s %d', path,= len(buf))
+        return buf
+
+    def open(self, path: str, size: int, offset: int) -> int:
+        '''
+        Make sure a range of the file is cached, and open the cached data file for reading it.  The cache daemon
+        passes the file descriptor to the frontend, which reads the range itself.
+        '''
+        self.fetch(path, size, offset)
+        with self._fileLock(path):
+            return os.open(self._dataPath(path), os.O_RDONLY)
+
+    def _readMemory(self, path: str, size: int, offset: int) -> bytes:
+        '''
+        Read whole blocks through the RAM tier.  The blocks that are not in RAM are read from the disk tier, fetching
+        them from the remote host first when needed, and added to the RAM tier.
+        '''
+        if size == 0:
+            return b''
+        first = offset // self.blockSize
+        last = (offset + size - 1) // self.blockSize
+        bufs: list[bytes] = []
+        metrics.counts.incr('ram_read')
+        for blockNum in range(first, last + 1):
+            buf = self.memory.get(path, blockNum)
+            if buf == None:
+                break
+            bufs.append(buf)
+            if len(buf) < self.blockSize:
+                break # end of file
+
+        if len(bufs) == last + 1 - first or (len(bufs) > 0 and len(bufs[-1]) < self.blockSize):
+            metrics.counts.incr('ram_hit')
+        else:
+            metrics.counts.incr('ram_miss')
+            generation = self.memory.generation(path)
+            start = (first + len(bufs)) * self.blockSize
+            buf = self.fetch(path, (last + 1) * self.blockSize - start, start, read=True)
+            for i in range(0, len(buf), self.blockSize):
+                self.memory.put(path, (start + i) // self.blockSize, buf[i:i+self.blockSize], generation)
+            bufs.append(buf)
+            metrics.counts.gauge('ram_MB', self.memory.size() / 1000000)
 
-        buf = bytearray()
+        skip = offset - first * self.blockSize
+        return b''.join(bufs)[skip:skip+size]
 
+    def fetch(self, path: str, size: int, offset: int, read: bool=False) -> bytes | None:
+        '''
+        Make sure a range of the file is cached, fetching the missing parts from the remote host, and optionally read
+        it from the cache.  Only one thread fetches a given range, other readers of the range wait for that fetch.
+        '''
         dataPath = self._dataPath(path)
-        d = os.path.dirname(dataPath)
-        if not os.path.exists(d):
-            os.makedirs(d)
-        if not os.path.exists(dataPath):
-            with open(dataPath, 'wb') as file:
-                fileSize = 0
-                st = metadata.cache.getattr(path)
-                if st != None:
-                    fileSize = st['st_size']
+        fetched = False
+        waited = False
+        remoteSize: int = None
+        fd: int = None
+        while True:
+            if remoteSize == None and not os.path.exists(dataPath):
+                remoteSize = self._remoteSize(path) # not under the file lock, it may be a remote lstat
+            ownedFetches: list[_Fetch] = []
+            waitFetches: list[_Fetch] = []
+            with self._fileLock(path):
+                if not os.path.exists(dataPath):
+                    if remoteSize == None:
+                        continue # deleted since it was checked
+                    self._createDataFile(dataPath, remoteSize)
+                remoteSize = None
+                fileSize = os.path.getsize(dataPath)
+                start, end = self._fetchRange(size, offset, fileSize)
+                extents = metadata.cache.extents(path)
+                inflight = self.inflight.setdefault(path, [])
+                inflightSorted = sorted(inflight, key=lambda fetch: fetch.start)
+                for gapStart, gapEnd in extents.missing(start, end):
+                    # wait for the fetches in flight that overlap the gap, and claim the rest of it
+                    for fetch in inflightSorted:
+                        if fetch.end <= gapStart or fetch.start >= gapEnd:
+                            continue
+                        waitFetches.append(fetch)
+                        if fetch.start > gapStart:
+                            ownedFetches.append(_Fetch(gapStart, fetch.start))
+                        gapStart = max(gapStart, fetch.end)
+                    if gapStart < gapEnd:
+                        ownedFetches.append(_Fetch(gapStart, gapEnd))
+                inflight += ownedFetches
+
+                if len(ownedFetches) == 0 and len(waitFetches) == 0:
+                    if len(inflight) == 0:
+                        self.inflight.pop(path)
+                    if read:
+                        fd = os.open(dataPath, os.O_RDONLY) # read after releasing the lock
+                    break
+
+            if len(ownedFetches) > 0:
+                if self._striped(fileSize, ownedFetches):
+                    self._fetchStriped(path, dataPath, ownedFetches)
                 else:
-                    fileSize = sftp.manager.sftp().lstat(sftp.fixPath(path)).st_size
-                file.truncate(fileSize)       
+                    self._fetchRanges(path, dataPath, ownedFetches)
+                fetched = True
+
+            for fetch in waitFetches:
+                # another thread is already fetching this range
+                fetch.done.wait()
+                metrics.counts.incr('read_fetch_avoided')
+                waited = True
+
+        if fetched or waited:
+            metrics.counts.incr('read_miss')
+            sftp.manager.markRemote() # the stripes are fetched by other threads
+        else:
+            metrics.counts.incr('read_hit')
 
-        blockMap = metadata.cache.blockmap(path)
-        blockNumSlice = range(math.floor(offset / Data.BLOCK_SIZE) , min(math.ceil((offset + size) / Data.BLOCK_SIZE), len(blockMap))) 
-              
+        # More unread data?
+        if fetched and len(extents.missing(0, fileSize)) > 0:
+            self.fileReaderQueue.put(path)
+
+        if fd == None:
+            return None
         try:
-            if not 1 in blockMap[blockNumSlice[0]:blockNumSlice[-1]+1]:            
-                with sftp.manager.sftp().open(sftp.fixPath(path), 'rb') as file:
-                    file.seek(blockNumSlice[0]*Data.BLOCK_SIZE)
-                    tempBuf = file.read(len(blockNumSlice)*Data.BLOCK_SIZE)
+            return os.pread(fd, size, offset)
+        finally:
+            os.close(fd)
 
-                with open(dataPath, 'rb+') as file:
-                    file.seek(blockNumSlice[0]*Data.BLOCK_SIZE)
-                    file.write(tempBuf)
-
-                for blockNum in blockNumSlice:                    
-                    blockMap[blockNum] = 1
-                metadata.cache.blockmap_save(path, blockMap)
-
-                blockOffset = offset%Data.BLOCK_SIZE
-                buf = tempBuf[blockOffset:min(len(tempBuf), blockOffset+size)]
-
-                # More unread blocks?
-                if 0 in blockMap:
-                    self.fileReaderQueue.put(path)
-            else:                     
-                for blockNum in blockNumSlice:
-                    if blockMap[blockNum] == 0:
-                        #self.log.debug('read: %s get block %d from remote', path, blockNum)
-                        with sftp.manager.sftp().open(sftp.fixPath(path), 'rb') as file:                                       
-                            file.seek(blockNum*Data.BLOCK_SIZE)
-                            block = file.read(Data.BLOCK_SIZE) 
-                                                
-                        with open(dataPath, 'rb+') as file:
-                            file.seek(blockNum*Data.BLOCK_SIZE)
-                            file.write(block) 
-
-                        blockMap[blockNum] = 1
-                        metadata.cache.blockmap_save(path, blockMap)
-
-                        if len(buf) == 0:
-                            blockOffset = offset%Data.BLOCK_SIZE                            
-                            buf = block[blockOffset : min(Data.BLOCK_SIZE, blockOffset+size)]
-                        else:
-                            buf += block[0 : min(Data.BLOCK_SIZE, size-len(buf))]
-                    else:
-                        with open(dataPath, 'rb') as file:
-                            if len(buf) == 0:
-                                file.seek(offset)                        
-                                buf = file.read(min(size, Data.BLOCK_SIZE-offset%Data.BLOCK_SIZE))                    
-                            else:
-                                file.seek(blockNum*Data.BLOCK_SIZE)    
-                                buf += file.read(min(Data.BLOCK_SIZE, size-len(buf)))                           
-        except Exception as e:            
-            self.log.error('read: %s size=%d offset=%d', path, size, offset)
-            self.log.error('read: %s blockMap=%s', path, blockMap)
-            self.log.error('read: %s blockMap=%s', path, blockNumSlice)
+    def _fetchRange(self, size: int, offset: int, fileSize: int) -> tuple[int, int]:
+        '''
+        The range to fetch for a read.  Small files are fetched whole, larger files in aligned blocks.
+        '''
+        if fileSize <= Data.WHOLE_FILE_SIZE:
+            return 0, fileSize
+        start = offset // self.blockSize * self.blockSize
+        end = min(math.ceil((offset + size) / self.blockSize) * self.blockSize, fileSize)
+        return start, end
+
+    def _prefetchSize(self, fileSize: int) -> int:
+        '''
+        Background reads of large files use larger requests, up to MAX_PREFETCH_SIZE.
+        '''
+        return max(self.blockSize, min(Data.MAX_PREFETCH_SIZE, fileSize // 16) // self.blockSize * self.blockSize)
+
+    def _fetchRanges(self, path: str, dataPath: str, fetches: list[_Fetch]):
+        '''
+        Fetch the ranges claimed by this thread from the remote host.  The SFTP read requests are pipelined.
+        '''
+        try:
+            with sftp.manager.sftp().open(sftp.fixPath(path), 'rb') as file:
+                bufs = list(file.readv([(fetch.start, fetch.end - fetch.start) for fetch in fetches]))
+            metrics.counts.incr('read_fetch', len(fetches))
+            metrics.counts.incr('read_fetch_bytes', sum(len(buf) for buf in bufs))
+
+            with self._fileLock(path):
+                # skip ranges of a file that was changed, renamed or deleted while fetching
+                fresh = [(fetch, buf) for fetch, buf in zip(fetches, bufs) if not fetch.stale]
+                if len(fresh) > 0:
+                    extents = metadata.cache.extents(path)
+                    with open(dataPath, 'rb+') as file:
+                        for fetch, buf in fresh:
+                            file.seek(fetch.start)
+                            file.write(buf)
+                            extents.add(fetch.start, fetch.end) # a short read past the remote end of file reads back as zeros
+                    metadata.cache.extents_save(path, extents)
+        except Exception as e:
+            self.log.error('read: %s ranges=%s %s', path, [(fetch.start, fetch.end) for fetch in fetches], e)
             raise e
-       
-        #self.log.debug('read: %s %d', path,= len(buf))
-        return bytes(buf)  
+        finally:
+            with self._fileLock(path):
+                inflight = self.inflight[path]
+                for fetch in fetches:
+                    inflight.remove(fetch)
+                    fetch.done.set()
+                if len(inflight) == 0:
+                    self.inflight.pop(path)
+
+    def _striped(self, fileSize: int, fetches: list[_Fetch]) -> bool:
+        return (self.stripes > 1 and fileSize >= self.stripeMinSize and
+                sum(fetch.end - fetch.start for fetch in fetches) >= 2 * self.blockSize)
+
+    def _fetchStriped(self, path: str, dataPath: str, fetches: list[_Fetch]):
+        '''
+        Split the ranges into stripes that are fetched in parallel, each over its own SSH connection.  A single SSH
+        channel is limited by its window and by decrypting on one core.
+        '''
+        stripes: list[tuple[_Fetch, int, int]] = []
+        for fetch in fetches:
+            stripeSize = max(self.blockSize, math.ceil((fetch.end - fetch.start) / self.stripes / self.blockSize) * self.blockSize)
+            for start in range(fetch.start, fetch.end, stripeSize):
+                stripes.append((fetch, start, min(start + stripeSize, fetch.end)))
+
+        startTime = time.time()
+        try:
+            futures = [self._stripePool().submit(self._fetchStripe, path, dataPath, fetch, start, end) for fetch, start, end in stripes]
+            nbytes = sum(future.result() for future in futures)
+            metrics.counts.incr('stripe_fetch', len(stripes))
+            metrics.counts.throughput('stripe', nbytes, time.time() - startTime)
+        except Exception as e:
+            self.log.error('read: %s stripes=%s %s', path, [(start, end) for fetch, start, end in stripes], e)
+            raise e
+        finally:
+            with self._fileLock(path):
+                inflight = self.inflight[path]
+                for fetch in fetches:
+                    inflight.remove(fetch)
+                    fetch.done.set()
+                if len(inflight) == 0:
+                    self.inflight.pop(path)
+
+    def _fetchStripe(self, path: str, dataPath: str, fetch: _Fetch, start: int, end: int) -> int:
+        with sftp.manager.sftp().open(sftp.fixPath(path), 'rb') as file:
+            buf = b''.join(file.readv([(start, end - start)]))
+        metrics.counts.incr('read_fetch')
+        metrics.counts.incr('read_fetch_bytes', len(buf))
+
+        # written straight into the data file, so readers can use each stripe as soon as it arrives
+        with self._fileLock(path):
+            if not fetch.stale:
+                with open(dataPath, 'rb+') as file:
+                    file.seek(start)
+                    file.write(buf)
+                extents = metadata.cache.extents(path)
+                extents.add(start, end)
+                metadata.cache.extents_save(path, extents)
+        return len(buf)
+
+    def _stripePool(self) -> ThreadPoolExecutor:
+        # the worker threads are kept, so each one keeps its own SSH connection
+        with self.lock:
+            if self.stripePool == None:
+                self.stripePool = ThreadPoolExecutor(max_workers=self.stripes, thread_name_prefix='stripe')
+            return self.stripePool
+
+    def _remoteSize(self, path: str) -> int:
+        st = metadata.cache.getattr(path)
+        if st != None:
+            return st['st_size']
+        return sftp.manager.sftp().lstat(sftp.fixPath(path)).st_size
+
+    def _createDataFile(self, dataPath: str, fileSize: int):
+        d = os.path.dirname(dataPath)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        with open(dataPath, 'wb') as file:
+            file.truncate(fileSize)
+
+    def _resize(self, path: str, dataPath: str, fileSize: int) -> Extents:
+        '''
+        Resize the data file and return the resized extents.  The range past the old end of file is a hole that reads
+        back as zeros both locally and on the remote host, so it is cached.
+        '''
+        extents = metadata.cache.extents(path)
+        oldSize = os.path.getsize(dataPath)
+        if fileSize != oldSize:
+            os.truncate(dataPath, fileSize)
+        if fileSize < oldSize:
+            extents.truncate(fileSize)
+        else:
+            extents.add(oldSize, fileSize)
+        return extents
+
+    def _fileLock(self, path: str) -> threading.RLock:
+        return self.fileLocks[hash(path) % len(self.fileLocks)]
+
+    def writeLock(self, path: str) -> threading.Lock:
+        return self.writeLocks[hash(path) % len(self.writeLocks)]
+
+    def invalidateMemory(self, path: str, tree: bool=False):
+        '''
+        Drop the RAM tier blocks of the file, or of the tree, and stop blocks that are being read from being added.
+        '''
+        if self.memory != None:
+            self.memory.invalidate(path, tree)
+            metrics.counts.gauge('ram_MB', self.memory.size() / 1000000)
+
+    def _markStale(self, path: str, tree: bool=False):
+        self.invalidateMemory(path, tree)
+        paths = [path]
+        if tree:
+            prefix = path.rstrip('/') + '/'
+            paths = [p for p in list(self.inflight.keys()) if p == path or p.startswith(prefix)]
+        for p in paths:
+            for fetch in self.inflight.get(p, []):
+                fetch.stale = True
 
     def fileReaderThread(self):
         while True:
             path = self.fileReaderQueue.get()
             self.log.debug('-> fileReaderThread %s', path)
-            blockMap = metadata.cache.blockmap(path)  
-            unreadBlockFound = False          
-            for i in range(0, len(blockMap)):
-                if blockMap[i] == 0: 
-                    size = Data.BLOCK_SIZE
-                    offset = i * Data.BLOCK_SIZE
-                    self.log.debug('<- fileReaderThread %s size=%s offset=%s', path, size, offset)
-                    self.read(path, size, offset, 0) 
-                    unreadBlockFound = True                    
-                    break
+            try:
+                dataPath = self._dataPath(path)
+                with self._fileLock(path):
+                    if not os.path.exists(dataPath):
+                        continue
+                    fileSize = os.path.getsize(dataPath)
+                    gaps = metadata.cache.extents(path).missing(0, fileSize)
 
-            if unreadBlockFound:
-                metrics.counts.incr('fileReaderThread')
-            else:
-                self.log.debug('<- fileReaderThread %s all blocks read', path)
+                if len(gaps) > 0:
+                    size = self._prefetchSize(fileSize)
+                    if self.stripes > 1 and fileSize >= self.stripeMinSize:
+                        size *= self.stripes # one prefetch request per stripe
+                    offset = gaps[0][0]
+                    self.log.debug('<- fileReaderThread %s size=%s offset=%s', path, size, offset)
+                    self.fetch(path, size, offset)
+                    metrics.counts.incr('fileReaderThread')
+                else:
+                    self.log.debug('<- fileReaderThread %s all blocks read', path)
+            except Exception as e:
+                self.log.error('<- fileReaderThread %s %s', path, e)
+                metrics.counts.incr('fileReaderThread_except')
 
-cache: Data = None
\ No newline at end of file
+cache: Data = None
@@ -0,0 +1,88 @@
+from array import array
+import bisect
+
+class Extents:
+    '''
+    The byte ranges of a file that are cached, as sorted [start, end) intervals.  Overlapping and adjacent ranges
+    are merged, so a file that is read sequentially is tracked by a single extent regardless of its size.
+    '''
+
+    def __init__(self):
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+
+    @staticmethod
+    def fromBytes(buf: bytes) -> 'Extents':
+        a = array('Q')
+        a.frombytes(buf)
+        extents = Extents()
+        extents.starts = list(a[0::2])
+        extents.ends = list(a[1::2])
+        return extents
+
+    @staticmethod
+    def fromBlockMap(blockMap: bytes, blockSize: int, size: int=None) -> 'Extents':
+        '''
+        Convert a blockmap.  The last block of a file is usually partial, the extents are clamped to the size of the
+        file when it is known.
+        '''
+        extents = Extents()
+        for blockNum, cached in enumerate(blockMap):
+            if cached:
+                extents.add(blockNum*blockSize, (blockNum+1)*blockSize)
+        if size != None:
+            extents.truncate(size)
+        return extents
+
+    def toBytes(self) -> bytes:
+        a = array('Q', [0] * (2*len(self.starts)))
+        a[0::2] = array('Q', self.starts)
+        a[1::2] = array('Q', self.ends)
+        return a.tobytes()
+
+    def add(self, start: int, end: int):
+        if start >= end:
+            return
+        # first extent that ends at or after start, and first extent that starts after end
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j-1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def truncate(self, size: int):
+        i = bisect.bisect_left(self.starts, size)
+        del self.starts[i:]
+        del self.ends[i:]
+        if i > 0 and self.ends[i-1] > size:
+            self.ends[i-1] = size
+
+    def missing(self, start: int, end: int) -> list[tuple[int, int]]:
+        '''
+        The ranges within [start, end) that are not cached.
+        '''
+        gaps: list[tuple[int, int]] = []
+        i = bisect.bisect_right(self.ends, start)
+        while start < end:
+            if i == len(self.starts) or self.starts[i] >= end:
+                gaps.append((start, end))
+                break
+            if self.starts[i] > start:
+                gaps.append((start, self.starts[i]))
+            start = self.ends[i]
+            i += 1
+        return gaps
+
+    def contains(self, start: int, end: int) -> bool:
+        return len(self.missing(start, end)) == 0
+
+    def cachedBytes(self, size: int) -> int:
+        return sum(min(end, size) - start for start, end in self if start < size)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __len__(self) -> int:
+        return len(self.starts)
@@ -0,0 +1,290 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import argparse
+import os
+from pathlib import Path
+import re
+import stat
+import time
+
+from sshfs_offline.cache import data
+from sshfs_offline.cache import metadata
+from sshfs_offline.cache.extents import Extents
+
+class Mount:
+    '''
+    Cache contents of one mounted remote directory, keyed by the path on the mount.
+    '''
+    def __init__(self, host: str, basedir: str):
+        self.host = host
+        self.basedir = basedir
+        self.entries: dict[str, dict[str, os.stat_result]] = dict() # path -> metadata file -> stat
+        self.dataFiles: dict[str, os.stat_result] = dict() # path -> data file stat
+
+    def name(self) -> str:
+        return '{}:/{}'.format(self.host, self.basedir)
+
+class Inspector:
+    '''
+    Inspect the ~/.sshfs-offline cache without a live mount.  The metadata and data directories are walked with a
+    pool of threads, so caches with millions of entries can be scanned quickly.
+    '''
+    WORKERS = 16
+    AGES = [(60, '< 1 min'), (5*60, '< 5 min'), (60*60, '< 1 hour'), (24*60*60, '< 1 day'), (7*24*60*60, '< 1 week'), (None, 'older')]
+    HIT_RATIOS = [('getattr', 'getattr_hit'), ('readdir', 'readdir_hit'), ('readlink', 'readlink_hit'), ('read', 'read_hit'), ('ram_read', 'ram_hit')]
+    METRICS_LINE = re.compile(r'^\s+(\S+)\s*: (\d+)$')
+
+    def __init__(self, host: str=None):
+        self.host = host
+        self.mounts: list[Mount] = []
+
+    def scan(self):
+        hosts = set()
+        for d in [metadata.Metadata.METADATA_DIR, data.Data.DATA_DIR]:
+            if os.path.isdir(d):
+                hosts |= set(os.listdir(d))
+        if self.host != None:
+            hosts &= {self.host}
+
+        for host in sorted(hosts):
+            mounts: dict[str, Mount] = dict()
+
+            # metadata/<host>/<basedir>/<%path>/<operation>
+            hostDir = os.path.join(metadata.Metadata.METADATA_DIR, host)
+            for filePath, st in self._walk(hostDir):
+                entryDir, operation = os.path.split(filePath)
+                basedirPath, entryName = os.path.split(entryDir)
+                if not entryName.startswith('%'):
+                    continue
+                basedir = os.path.relpath(basedirPath, hostDir).replace(os.sep, '/')
+                if basedir == '.':
+                    basedir = '' # mounted at the remote root
+                mount = mounts.setdefault(basedir, Mount(host, basedir))
+                path = entryName.replace('%', '/')
+                mount.entries.setdefault(path, dict())[operation] = st
+
+            # data/<host>/<basedir>/<path>, a data file belongs to the mount with the longest matching basedir
+            hostDir = os.path.join(data.Data.DATA_DIR, host)
+            basedirs = sorted(mounts.keys(), key=len, reverse=True)
+            for filePath, st in self._walk(hostDir):
+                rel = os.path.relpath(filePath, hostDir).replace(os.sep, '/')
+                basedir = next((b for b in basedirs if b == '' or rel.startswith(b + '/')), '')
+                mount = mounts.setdefault(basedir, Mount(host, basedir))
+                mount.dataFiles['/' + rel[len(basedir):].lstrip('/')] = st
+
+            self.mounts += [mounts[basedir] for basedir in sorted(mounts.keys())]
+
+    def stats(self, depth: int, metricsLog: str):
+        now = time.time()
+        for mount in self.mounts:
+            print(mount.name())
+
+            print('  metadata entries: {}'.format(len(mount.entries)))
+            operations = [metadata.Metadata.GETATTR, metadata.Metadata.READDIR, metadata.Metadata.READLINK, metadata.Metadata.EXTENTS]
+            print('    {:<10}{:>10}'.format('', 'count') + ''.join('{:>10}'.format(label) for limit, label in Inspector.AGES))
+            for operation in operations:
+                hist = [0] * len(Inspector.AGES)
+                for files in mount.entries.values():
+                    if operation in files:
+                        hist[self._ageBucket(now - files[operation].st_ctime)] += 1
+                print('    {:<10}{:>10}'.format(operation, sum(hist)) + ''.join('{:>10}'.format(n) for n in hist))
+
+            complete = partial = 0
+            size = cached = 0
+            subtrees: dict[str, int] = dict()
+            for path, st in mount.dataFiles.items():
+                fileCached = self._cachedBytes(mount, path, st)
+                size += st.st_size
+                cached += fileCached
+                if fileCached >= st.st_size:
+                    complete += 1
+                elif fileCached > 0:
+                    partial += 1
+                subtree = '/' + '/'.join(path.split('/')[1:-1][:depth])
+                subtrees[subtree] = subtrees.get(subtree, 0) + fileCached
+            orphans = self._orphans(mount)
+            print('  data files: {} ({} complete, {} partial, {} orphaned)'.format(len(mount.dataFiles), complete, partial, len(orphans)))
+            print('  data bytes: {} cached of {}'.format(self._size(cached), self._size(size)))
+            if len(subtrees) > 0:
+                print('  cached bytes by subtree:')
+                for subtree, n in sorted(subtrees.items(), key=lambda item: item[1], reverse=True):
+                    print('    {:>10}  {}'.format(self._size(n), subtree))
+
+        counts = self._metricsCounts(metricsLog)
+        if len(counts) > 0:
+            print('hit ratios ({}):'.format(metricsLog))
+            for op, hit in Inspector.HIT_RATIOS:
+                if counts.get(op, 0) > 0:
+                    print('  {:<10}{:>7.1%}  ({} of {})'.format(op, counts.get(hit, 0) / counts[op], counts.get(hit, 0), counts[op]))
+
+    def ls(self, prefix: str):
+        now = time.time()
+        prefix = '/' + prefix.strip('/')
+        for mount in self.mounts:
+            for path in sorted(mount.dataFiles.keys()):
+                if prefix != '/' and path != prefix and not path.startswith(prefix + '/'):
+                    continue
+                st = mount.dataFiles[path]
+                fileCached = self._cachedBytes(mount, path, st)
+                percent = 100 * fileCached / st.st_size if st.st_size > 0 else 100
+                print('{:>5.0f}% {:>10} {:>10} {:>9} {}{}'.format(percent, self._size(fileCached), self._size(st.st_size),
+                                                             self._age(now - st.st_ctime), mount.name().rstrip('/'), path))
+
+    def verify(self, delete: bool) -> int:
+        problems = 0
+        for mount in self.mounts:
+            for path in self._orphans(mount):
+                print('orphaned data file: {}{}'.format(mount.name().rstrip('/'), path))
+                problems += 1
+                if delete:
+                    self._unlink(self._dataPath(mount, path))
+            for path, files in mount.entries.items():
+                for operation in [metadata.Metadata.EXTENTS, metadata.Metadata.BLOCKMAP]:
+                    if operation in files and path not in mount.dataFiles:
+                        print('{} without data file: {}{}'.format(operation, mount.name().rstrip('/'), path))
+                        problems += 1
+                        if delete:
+                            self._unlink(os.path.join(self._metadataDir(mount, path), operation))
+            for path, st in mount.dataFiles.items():
+                if metadata.Metadata.EXTENTS not in mount.entries.get(path, dict()):
+                    continue
+                extents = self._extents(mount, path)
+                # extents converted from a blockmap can cover the rest of the partial last block, reads stop at the
+                # end of the file
+                if extents != None and len(extents) > 0 and extents.ends[-1] > st.st_size + metadata.Metadata.BLOCKMAP_BLOCK_SIZE:
+                    print('extents past the end of the data file: {}{}'.format(mount.name().rstrip('/'), path))
+                    problems += 1
+                    if delete:
+                        for operation in [metadata.Metadata.EXTENTS, metadata.Metadata.BLOCKMAP]:
+                            if operation in mount.entries[path]:
+                                self._unlink(os.path.join(self._metadataDir(mount, path), operation))
+                        self._unlink(self._dataPath(mount, path))
+        print('{} problems found'.format(problems))
+        return problems
+
+    #
+    # Private methods:
+    #
+
+    def _unlink(self, path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass # removed by a mount while verifying
+
+    def _walk(self, root: str) -> list[tuple[str, os.stat_result]]:
+        '''
+        Parallel walk of a directory tree, one os.scandir per task.  Returns the regular files and their stat.
+        '''
+        files: list[tuple[str, os.stat_result]] = []
+        if not os.path.isdir(root):
+            return files
+        with ThreadPoolExecutor(max_workers=Inspector.WORKERS) as executor:
+            futures = {executor.submit(self._scandir, root)}
+            while len(futures) > 0:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dirFiles, subdirs = future.result()
+                    files += dirFiles
+                    futures |= {executor.submit(self._scandir, subdir) for subdir in subdirs}
+        return files
+
+    def _scandir(self, path: str) -> tuple[list[tuple[str, os.stat_result]], list[str]]:
+        files: list[tuple[str, os.stat_result]] = []
+        subdirs: list[str] = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry.path, entry.stat(follow_symlinks=False)))
+        except FileNotFoundError:
+            pass # removed while scanning
+        return files, subdirs
+
+    def _cachedBytes(self, mount: Mount, path: str, st: os.stat_result) -> int:
+        extents = self._extents(mount, path)
+        if extents == None:
+            return 0
+        return extents.cachedBytes(st.st_size)
+
+    def _extents(self, mount: Mount, path: str) -> Extents | None:
+        files = mount.entries.get(path, dict())
+        try:
+            if metadata.Metadata.EXTENTS in files:
+                with open(os.path.join(self._metadataDir(mount, path), metadata.Metadata.EXTENTS), 'rb') as file:
+                    return Extents.fromBytes(file.read())
+            if metadata.Metadata.BLOCKMAP in files:
+                with open(os.path.join(self._metadataDir(mount, path), metadata.Metadata.BLOCKMAP), 'rb') as file:
+                    st = mount.dataFiles.get(path)
+                    return Extents.fromBlockMap(file.read(), metadata.Metadata.BLOCKMAP_BLOCK_SIZE,
+                                                st.st_size if st != None else None)
+        except FileNotFoundError:
+            pass # removed while scanning
+        return None
+
+    def _orphans(self, mount: Mount) -> list[str]:
+        '''
+        Data files that have neither a getattr nor an extents metadata entry.
+        '''
+        known = {metadata.Metadata.GETATTR, metadata.Metadata.EXTENTS, metadata.Metadata.BLOCKMAP}
+        return sorted(path for path in mount.dataFiles if known.isdisjoint(mount.entries.get(path, dict())))
+
+    def _metadataDir(self, mount: Mount, path: str) -> str:
+        return os.path.join(metadata.Metadata.METADATA_DIR, mount.host, mount.basedir, path.replace('/', '%'))
+
+    def _dataPath(self, mount: Mount, path: str) -> str:
+        return os.path.join(data.Data.DATA_DIR, mount.host, mount.basedir, path[1:])
+
+    def _metricsCounts(self, metricsLog: str) -> dict[str, int]:
+        counts: dict[str, int] = dict()
+        if os.path.exists(metricsLog):
+            with open(metricsLog, 'r') as file:
+                for line in file:
+                    m = Inspector.METRICS_LINE.match(line)
+                    if m != None:
+                        counts[m.group(1)] = counts.get(m.group(1), 0) + int(m.group(2))
+        return counts
+
+    def _ageBucket(self, age: float) -> int:
+        for i, (limit, label) in enumerate(Inspector.AGES):
+            if limit == None or age < limit:
+                return i
+
+    def _age(self, age: float) -> str:
+        for limit, divisor, unit in [(60, 1, 's'), (60*60, 60, 'm'), (24*60*60, 60*60, 'h')]:
+            if age < limit:
+                return '{:.0f}{}'.format(age / divisor, unit)
+        return '{:.0f}d'.format(age / (24*60*60))
+
+    def _size(self, n: int) -> str:
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if n < 1024:
+                return '{:.1f}{}'.format(n, unit) if unit != 'B' else '{}B'.format(n)
+            n /= 1024
+        return '{:.1f}TB'.format(n)
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog='sshfs-offline cache')
+    parser.description = 'Inspect the ~/.sshfs-offline cache.  A mount is not needed.'
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    statsParser = subparsers.add_parser('stats', help='cached bytes, metadata entry ages, orphaned files and hit ratios')
+    statsParser.add_argument('--depth', type=int, default=1, help='subtree depth to report cached bytes for (default=1)')
+    statsParser.add_argument('--metrics', default=os.path.join(Path.home(), '.sshfs-offline', 'metrics.log'), help='metrics log to compute hit ratios from')
+    lsParser = subparsers.add_parser('ls', help='list cached files and how much of each file is cached')
+    lsParser.add_argument('path', nargs='?', default='/', help='only list files below path on the mount')
+    verifyParser = subparsers.add_parser('verify', help='find orphaned data files and inconsistent extents')
+    verifyParser.add_argument('--delete', action='store_true', help='delete the orphaned and inconsistent cache files')
+    for p in [statsParser, lsParser, verifyParser]:
+        p.add_argument('--host', help='only inspect the cache of this host')
+    args = parser.parse_args(argv)
+
+    inspector = Inspector(args.host)
+    inspector.scan()
+    if args.command == 'stats':
+        inspector.stats(args.depth, args.metrics)
+    elif args.command == 'ls':
+        inspector.ls(args.path)
+    elif args.command == 'verify':
+        if inspector.verify(args.delete) > 0 and not args.delete:
+            exit(1)
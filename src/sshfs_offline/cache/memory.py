@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import threading
+
+class Memory:
+    '''
+    Bounded RAM tier of data blocks above the on-disk data cache, keyed by (path, block number).  Eviction is a
+    segmented LRU: blocks enter a probationary segment and are promoted to the protected segment when they are read
+    again, so a scan of a large file only evicts other blocks that were read once.
+    '''
+    PROTECTED = 0.8 # fraction of the memory for blocks that were read more than once
+    GENERATIONS = 256
+
+    def __init__(self, maxSize: int):
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.probation: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+        self.protected: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+        self.probationSize = 0
+        self.protectedSize = 0
+        self.blocks: dict[str, set[int]] = dict() # path -> cached block numbers
+        # Blocks read from the disk tier are only added when the file has not been invalidated since they were read.
+        # Files are hashed to a fixed set of generation counters.
+        self.generations = [0] * Memory.GENERATIONS
+
+    def generation(self, path: str) -> int:
+        with self.lock:
+            return self.generations[hash(path) % Memory.GENERATIONS]
+
+    def get(self, path: str, blockNum: int) -> bytes | None:
+        key = (path, blockNum)
+        with self.lock:
+            buf = self.protected.get(key)
+            if buf != None:
+                self.protected.move_to_end(key)
+                return buf
+            buf = self.probation.pop(key, None)
+            if buf != None:
+                # read again, promote to the protected segment
+                self.probationSize -= len(buf)
+                self.protected[key] = buf
+                self.protectedSize += len(buf)
+                while self.protectedSize > self.maxSize * Memory.PROTECTED:
+                    demoteKey, demoteBuf = self.protected.popitem(last=False)
+                    self.protectedSize -= len(demoteBuf)
+                    self.probation[demoteKey] = demoteBuf
+                    self.probationSize += len(demoteBuf)
+            return buf
+
+    def put(self, path: str, blockNum: int, buf: bytes, generation: int):
+        key = (path, blockNum)
+        with self.lock:
+            if (generation != self.generations[hash(path) % Memory.GENERATIONS] or len(buf) > self.maxSize or
+                key in self.probation or key in self.protected):
+                return
+            self.probation[key] = buf
+            self.probationSize += len(buf)
+            self.blocks.setdefault(path, set()).add(blockNum)
+            while self.probationSize + self.protectedSize > self.maxSize:
+                segment = self.probation if len(self.probation) > 0 else self.protected
+                evictKey, evictBuf = segment.popitem(last=False)
+                if segment is self.probation:
+                    self.probationSize -= len(evictBuf)
+                else:
+                    self.protectedSize -= len(evictBuf)
+                self._forget(evictKey)
+
+    def invalidate(self, path: str, tree: bool=False):
+        with self.lock:
+            paths = [path]
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                paths = [p for p in self.blocks.keys() if p == path or p.startswith(prefix)]
+                self.generations = [g + 1 for g in self.generations]
+            else:
+                self.generations[hash(path) % Memory.GENERATIONS] += 1
+            for p in paths:
+                for blockNum in self.blocks.pop(p, set()):
+                    key = (p, blockNum)
+                    buf = self.probation.pop(key, None)
+                    if buf != None:
+                        self.probationSize -= len(buf)
+                    buf = self.protected.pop(key, None)
+                    if buf != None:
+                        self.protectedSize -= len(buf)
+
+    def size(self) -> int:
+        with self.lock:
+            return self.probationSize + self.protectedSize
+
+    def _forget(self, key: tuple[str, int]):
+        path, blockNum = key
+        blockNums = self.blocks.get(path)
+        if blockNums != None:
+            blockNums.discard(blockNum)
+            if len(blockNums) == 0:
+                self.blocks.pop(path)
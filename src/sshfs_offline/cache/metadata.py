@@ -1,5 +1,6 @@
 
-import math
+from collections import OrderedDict
+import heapq
 from pathlib import Path
 import os
 from sshfs_offline import log
@@ -8,16 +9,25 @@ import json
 from logging import getLogger
 
 import shutil
+import stat
+import threading
 import time
+from typing import BinaryIO, Iterable, Iterator
 
 from errno import ENOENT
 
 from sshfs_offline.cache import data
+from sshfs_offline.cache.extents import Extents
 from sshfs_offline import metrics
 from sshfs_offline import sftp
 
 from fuse import FuseOSError
 
+GETATTR_KEYS = ('st_atime', 'st_gid', 'st_mode', 'st_mtime', 'st_size', 'st_uid')
+
+def getattrDict(st) -> dict:
+    return dict((key, getattr(st, key)) for key in GETATTR_KEYS)
+
 class Metadata:
     '''
     Metadata cache for getattr, readdir and read link operations.
@@ -25,22 +35,42 @@ class Metadata:
     METADATA_DIR = os.path.join(Path.home(), '.sshfs-offline', 'metadata')
     GETATTR = 'getattr'
     READDIR = 'readdir'
+    READDIR_MAGIC = b'SSHFSRD1' # starts a listing file, the older json lists do not have it
+    READDIR_LOG = 'readdir.log' # entries added and removed through the mount since the last listing
+    READDIR_LOG_MAX = 1024 * 1024
+    ENCODING = 'utf-8'
+    READ_SIZE = 65536
     READLINK = 'readlink'
-    BLOCKMAP = 'blockmap'
+    EXTENTS = 'extents'
+    BLOCKMAP = 'blockmap' # replaced by extents
+    BLOCKMAP_BLOCK_SIZE = 131072
+    READDIR_INDEX_MAX = 1024 # directories whose names are indexed in memory
+    READDIR_STRIPES = 256
     
     def __init__(self, host: str, basedir: str, cachetimeout: float):
         self.log = getLogger(log.METADATA)
 
         self.cachetimeout = cachetimeout
+
+        # readdir path -> (listing file key, names, readdir log size, added, removed), least recently used first
+        self.readdirIndex: OrderedDict[str, tuple[tuple, set[str], int, set[str], set[str]]] = OrderedDict()
+        self.readdirIndexLock = threading.Lock()
+
+        # Directories changed through the mount, hashed to a fixed set of stripes that hold the sequence number of
+        # their last change.  A listing fetched before a change is not saved over it.
+        self.readdirSequence = 0
+        self.readdirChanges = [0] * Metadata.READDIR_STRIPES
         
         self.metadataDir = os.path.join(Metadata.METADATA_DIR, host, os.path.splitroot(basedir)[-1])
         if not os.path.exists(self.metadataDir):
             os.makedirs(self.metadataDir)
 
-    def deleteMetadata(self, path, files=[GETATTR, READDIR, READLINK]):
+    def deleteMetadata(self, path, files=[GETATTR, READDIR, READDIR_LOG, READLINK]):
         if not sftp.manager.isConnected():
             return
-        
+
+        if Metadata.GETATTR in files:
+            data.cache.invalidateMemory(path) # the file was changed or removed
         mdPath = self._metadataPath(path)
         if os.path.exists(mdPath):
             for file in files:
@@ -49,68 +79,304 @@ class Metadata:
                     metrics.counts.incr('deleteMetadata')
                     os.unlink(filePath)
         
-    def deleteParentMetadata(self, path):
-        if not sftp.manager.isConnected():
-            return
-        
-        p = os.path.split(path)[0]
-        self.deleteMetadata(p)
-        
     # 'st_atime', 'st_gid', 'st_mode', 'st_mtime', 'st_size', 'st_uid'    
     def getattr(self, path)-> dict:
         return self._readCache(path, Metadata.GETATTR)
         
-    def getattr_save(self, path, dic: dict):        
+    def getattr_save(self, path, dic: dict, deleteStale: bool=True):
         if dic == {}:
             data.cache.deleteStaleFile(path)            
             self._storeCache(path, Metadata.GETATTR, dic)
         elif dic != None:           
-            data.cache.deleteStaleFile(path, dic['st_mtime']) 
+            if deleteStale:
+                data.cache.deleteStaleFile(path, dic['st_mtime'])
             self._storeCache(path, Metadata.GETATTR, dic)
        
-    def readdir(self, path)-> list[str]:       
-        return self._readCache(path, Metadata.READDIR)
-        
-    def readdir_save(self, path, s: list[str]=None):
-        self._storeCache(path, Metadata.READDIR, s)        
-                
+    def readdir(self, path) -> Iterator[str] | None:
+        '''
+        Iterate over the cached directory entries in sorted order, or return None when they are not cached.  The
+        entries are streamed from the cache file, so memory use does not grow with the directory size.
+        '''
+        readdirPath = self._metadataPath(path, Metadata.READDIR)
+        if not os.path.exists(readdirPath) or self._expired(path, readdirPath, Metadata.READDIR):
+            self.log.debug('readdir: not found %s', path)
+            return None
+        try:
+            # opened now, the entries are streamed after the listing may have been replaced or deleted
+            file = open(readdirPath, 'rb')
+        except FileNotFoundError:
+            return None
+        if file.read(len(Metadata.READDIR_MAGIC)) != Metadata.READDIR_MAGIC:
+            # json list written by an older version
+            file.close()
+            self.log.debug('readdir: old format %s', path)
+            self._deleteReaddir(readdirPath)
+            return None
+
+        self.log.debug('readdir: %s', path)
+        metrics.counts.incr('readdir_hit')
+        added, removed = self._readdirLog(self._metadataPath(path, Metadata.READDIR_LOG))
+        entries = heapq.merge((name for name in self._readdirNames(file) if name not in removed), sorted(added))
+        return self._unique(entries)
+
+    def readdir_contains(self, path, name: str) -> bool | None:
+        '''
+        Whether the cached directory entries contain the name, or None when they are not cached.  The names of
+        recently used listings are kept in hashed sets, which are rebuilt when the listing file is replaced and
+        patched when its readdir log grows.
+        '''
+        readdirPath = self._metadataPath(path, Metadata.READDIR)
+        if not os.path.exists(readdirPath) or self._expired(path, readdirPath, Metadata.READDIR):
+            return None
+        try:
+            st = os.stat(readdirPath)
+        except FileNotFoundError:
+            return None
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        logPath = self._metadataPath(path, Metadata.READDIR_LOG)
+        logSize = os.path.getsize(logPath) if os.path.exists(logPath) else 0
+
+        with self.readdirIndexLock:
+            entry = self.readdirIndex.get(readdirPath)
+            if entry != None:
+                self.readdirIndex.move_to_end(readdirPath)
+        if entry == None or entry[0] != key:
+            try:
+                file = open(readdirPath, 'rb')
+            except FileNotFoundError:
+                return None
+            with file:
+                if file.read(len(Metadata.READDIR_MAGIC)) != Metadata.READDIR_MAGIC:
+                    return None # json list written by an older version
+                metrics.counts.incr('readdir_index_build')
+                entry = (key, set(self._readdirNames(file)), -1, set(), set())
+        if entry[2] != logSize:
+            added, removed = self._readdirLog(logPath)
+            entry = (key, entry[1], logSize, added, removed)
+        with self.readdirIndexLock:
+            self.readdirIndex[readdirPath] = entry
+            self.readdirIndex.move_to_end(readdirPath)
+            while len(self.readdirIndex) > Metadata.READDIR_INDEX_MAX:
+                self.readdirIndex.popitem(last=False)
+
+        key, names, logSize, added, removed = entry
+        return name in added or (name in names and name not in removed)
+
+    def readdir_sequence(self) -> int:
+        '''
+        Sequence number of the last directory change, taken before fetching a listing to save with readdir_save.
+        '''
+        with self.readdirIndexLock:
+            return self.readdirSequence
+
+    def readdir_save(self, path, s: Iterable[str], sequence: int=None):
+        '''
+        Store the directory entries as sorted NUL separated names.  The entries are not stored when the directory was
+        changed through the mount after readdir_sequence returned sequence, they may not include the change.
+        '''
+        self.log.debug('readdir_save: %s', path)
+        if not sftp.manager.isConnected():
+            return
+        if sequence != None:
+            with self.readdirIndexLock:
+                changed = self.readdirChanges[hash(path) % Metadata.READDIR_STRIPES] > sequence
+            if changed:
+                self.log.debug('readdir_save: %s changed while listing', path)
+                metrics.counts.incr('readdir_save_changed')
+                return
+
+        readdirPath = self._metadataPath(path, Metadata.READDIR)
+        tempPath = readdirPath + '.tmp'
+        with open(tempPath, 'wb') as file:
+            file.write(Metadata.READDIR_MAGIC)
+            file.write(b'\0'.join(name.encode(Metadata.ENCODING, 'surrogateescape') for name in sorted(s)))
+        os.replace(tempPath, readdirPath)
+        logPath = self._metadataPath(path, Metadata.READDIR_LOG)
+        if os.path.exists(logPath):
+            os.unlink(logPath)
+
+    def readdir_add(self, path, name: str):
+        self._readdirPatch(path, b'+', name)
+
+    def readdir_remove(self, path, name: str):
+        self._readdirPatch(path, b'-', name)
+
+    def addParentEntry(self, path):
+        '''
+        Add the path to its parent's cached directory entries after it was created through the mount.
+        '''
+        parent, name = os.path.split(path)
+        self.readdir_add(parent, name)
+        self.deleteMetadata(parent, [Metadata.GETATTR]) # mtime changed
+
+    def removeParentEntry(self, path):
+        '''
+        Remove the path from its parent's cached directory entries after it was deleted through the mount.
+        '''
+        parent, name = os.path.split(path)
+        self.readdir_remove(parent, name)
+        self.deleteMetadata(parent, [Metadata.GETATTR]) # mtime changed
+
     def readlink(self, path:str) -> str | None:        
         return self._readCache(path, Metadata.READLINK)
            
     def readlink_save(self, path:str, link: str=None):        
         self._storeCache(path, Metadata.READLINK, link)        
     
-    def blockmap(self, path:str) -> bytearray | None:                   
-        bm = self._readCache(path, Metadata.BLOCKMAP)
-        metrics.counts.incr('blockmap')
-        # not sure how the blockMap can be zero length?
-        if bm != None and len(bm) == 0:
-            bm = None
-            self.log.warning('blockmap: %s zero length blockMap?', path)
-
-        if bm == None:
-            fileSize = 0
-            st = self.getattr(path)
-            if st != None:
-                fileSize = st['st_size']               
-            else:
-                fileSize = sftp.manager.sftp().lstat(sftp.fixPath(path)).st_size
-                
-            bm = bytearray(math.ceil(fileSize/data.cache.BLOCK_SIZE))            
-        
-        return bm    
-    
-    def blockmap_save(self, path:str, blockMap: bytearray):
-        metrics.counts.incr('blockmap_save')
-        self._storeCache(path, Metadata.BLOCKMAP, blockMap)        
-    
+    def extents(self, path: str) -> Extents:
+        '''
+        Cached byte ranges of the data file.  A blockmap written by an older version is converted to extents.
+        '''
+        metrics.counts.incr('extents')
+        buf = self._readCache(path, Metadata.EXTENTS)
+        if buf != None:
+            return Extents.fromBytes(buf)
+        buf = self._readCache(path, Metadata.BLOCKMAP)
+        if buf != None:
+            return Extents.fromBlockMap(buf, Metadata.BLOCKMAP_BLOCK_SIZE, data.cache.size(path))
+        return Extents()
+
+    def extents_save(self, path: str, extents: Extents):
+        metrics.counts.incr('extents_save')
+        self._storeCache(path, Metadata.EXTENTS, extents.toBytes())
+        self.deleteMetadata(path, [Metadata.BLOCKMAP])
+
+    def rename(self, old: str, new: str):
+        '''
+        Move the cached metadata of old, and of everything below old when it is a directory, to new.
+        '''
+        if not sftp.manager.isConnected():
+            return
+
+        oldName = self._metadataName(old)
+        newName = self._metadataName(new)
+        if self._cachedIsDir(old) == False:
+            # a file can only replace a file, only its own entries move and the metadata directory is not scanned
+            newNames = [name for name in [newName] if os.path.isdir(os.path.join(self.metadataDir, name))]
+            oldNames = [name for name in [oldName] if os.path.isdir(os.path.join(self.metadataDir, name))]
+        else:
+            newNames = self._metadataNames(newName)
+            oldNames = self._metadataNames(oldName)
+        for name in newNames:
+            shutil.rmtree(os.path.join(self.metadataDir, name)) # replaced by the rename
+        for name in oldNames:
+            metrics.counts.incr('rename_metadata')
+            os.rename(os.path.join(self.metadataDir, name), os.path.join(self.metadataDir, newName + name[len(oldName):]))
+
+        self.removeParentEntry(old)
+        self.addParentEntry(new)
+
     # 
     # Private methods:
     #
 
+    def _metadataName(self, path: str) -> str:
+        return path.replace('/','%').replace('\\', '%')
+
+    def _cachedIsDir(self, path: str) -> bool | None:
+        '''
+        Whether the cached getattr of the path, expired or not, is a directory, or None when it is not cached.
+        '''
+        try:
+            with open(os.path.join(self.metadataDir, self._metadataName(path), Metadata.GETATTR), 'r') as file:
+                d = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(d, dict) or 'st_mode' not in d:
+            return None
+        return stat.S_ISDIR(d['st_mode'])
+
+    def _metadataNames(self, name: str) -> list[str]:
+        '''
+        Names of the metadata directories for the path and everything below it.
+        '''
+        if name == '%':
+            prefix = name
+        else:
+            prefix = name + '%'
+        return [entry.name for entry in os.scandir(self.metadataDir)
+                if entry.name == name or entry.name.startswith(prefix)]
+
+    def _expired(self, path: str, metadataPath: str, operation: str) -> bool:
+        if time.time() > os.lstat(metadataPath).st_ctime + self.cachetimeout and sftp.manager.isConnected():
+            self.log.debug('_expired.%s: %s', operation, path)
+            if operation == Metadata.READDIR:
+                self._deleteReaddir(metadataPath)
+            else:
+                os.unlink(metadataPath)
+            metrics.counts.incr(operation+'_expired')
+            return True
+        return False
+
+    def _deleteReaddir(self, readdirPath: str):
+        for p in [readdirPath, os.path.join(os.path.dirname(readdirPath), Metadata.READDIR_LOG)]:
+            if os.path.exists(p):
+                os.unlink(p)
+
+    def _readdirPatch(self, path, op: bytes, name: str):
+        '''
+        Append an added (+) or removed (-) entry to the readdir log of a cached directory listing.
+        '''
+        if not sftp.manager.isConnected():
+            return
+        with self.readdirIndexLock:
+            self.readdirSequence += 1
+            self.readdirChanges[hash(path) % Metadata.READDIR_STRIPES] = self.readdirSequence
+
+        readdirPath = self._metadataPath(path, Metadata.READDIR)
+        if not os.path.exists(readdirPath) or self._expired(path, readdirPath, Metadata.READDIR):
+            return
+        logPath = self._metadataPath(path, Metadata.READDIR_LOG)
+        with open(logPath, 'ab') as file:
+            file.write(op + name.encode(Metadata.ENCODING, 'surrogateescape') + b'\0')
+            logSize = file.tell()
+        metrics.counts.incr('readdir_patch')
+        if logSize > Metadata.READDIR_LOG_MAX:
+            # relisting the directory is cheaper than merging a long log on every read
+            self._deleteReaddir(readdirPath)
+
+    def _readdirLog(self, logPath: str) -> tuple[set[str], set[str]]:
+        added: set[str] = set()
+        removed: set[str] = set()
+        try:
+            file = open(logPath, 'rb')
+        except FileNotFoundError:
+            return added, removed
+        for name in self._readdirNames(file):
+            if name[0] == '+':
+                added.add(name[1:])
+                removed.discard(name[1:])
+            else:
+                removed.add(name[1:])
+                added.discard(name[1:])
+        return added, removed
+
+    def _readdirNames(self, file: BinaryIO) -> Iterator[str]:
+        '''
+        Stream the NUL separated names from the current position of the file, and close it.
+        '''
+        with file:
+            rest = b''
+            while True:
+                buf = file.read(Metadata.READ_SIZE)
+                if len(buf) == 0:
+                    break
+                names = (rest + buf).split(b'\0')
+                rest = names.pop()
+                for name in names:
+                    yield name.decode(Metadata.ENCODING, 'surrogateescape')
+            if len(rest) > 0:
+                yield rest.decode(Metadata.ENCODING, 'surrogateescape')
+
+    def _unique(self, names: Iterator[str]) -> Iterator[str]:
+        prev = None
+        for name in names:
+            if name != prev:
+                yield name
+            prev = name
+
     def _metadataPath(self, path: str, operation: str=None) -> str:
-        p = path.replace('/','%').replace('\\', '%')
-        d = os.path.join(self.metadataDir, p)
+        d = os.path.join(self.metadataDir, self._metadataName(path))
         if not os.path.exists(d):
             os.mkdir(d)
         if operation == None:
@@ -118,13 +384,13 @@ class Metadata:
         else:
             return os.path.join(d, operation)
                    
-    def _storeCache(self, path, operation, d: dict | list[str] | str | bytearray):  
+    def _storeCache(self, path, operation, d: dict | list[str] | str | bytes):  
         self.log.debug('_storeCace.%s: %s', operation, path)     
         if not sftp.manager.isConnected():
             return
          
         p = self._metadataPath(path, operation)
-        if operation == Metadata.BLOCKMAP:            
+        if operation in (Metadata.EXTENTS, Metadata.BLOCKMAP):
             with open(p, "wb") as file:
                 file.write(bytes(d))
         else:
@@ -134,20 +400,17 @@ class Metadata:
                 else:
                     json.dump(d, file, indent=4)
 
-    def _readCache(self, path, operation) -> dict | list[str] | str | bytearray:       
+    def _readCache(self, path, operation) -> dict | list[str] | str | bytes:       
         metadataPath = self._metadataPath(path, operation)        
         if os.path.exists(metadataPath):
-            if operation == Metadata.BLOCKMAP:
+            if operation in (Metadata.EXTENTS, Metadata.BLOCKMAP):
                 with open(metadataPath, 'rb') as file:
                     buf = file.read()
-                    self.log.debug('_readCache.%s: %s %s', operation, path, str(buf))   
-                    metrics.counts.incr('blockmap_hit')
-                    return bytearray(buf)
+                    self.log.debug('_readCache.%s: %s %d bytes', operation, path, len(buf))
+                    metrics.counts.incr(operation+'_hit')
+                    return buf
             else:
-                if time.time() > os.lstat(metadataPath).st_ctime + self.cachetimeout and sftp.manager.isConnected():            
-                    self.log.debug('_readCache.%s: expired %s', operation, path)
-                    os.unlink(metadataPath)
-                    metrics.counts.incr(operation+'_expired')    
+                if self._expired(path, metadataPath, operation):
                     return None
                 else:                
                     with open(metadataPath, 'r') as file:                    
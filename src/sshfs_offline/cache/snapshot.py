@@ -0,0 +1,167 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging import getLogger
+import os
+import shlex
+import stat
+import threading
+
+import paramiko
+
+from sshfs_offline import log
+from sshfs_offline import metrics
+from sshfs_offline import sftp
+
+from sshfs_offline.cache import metadata
+
+class Snapshot:
+    '''
+    Seed the metadata cache with the getattr, readdir and readlink entries of a whole remote subtree.  A single
+    find command is run over an SSH exec channel and its output is parsed as it streams in.  When exec is not
+    allowed, or find does not support -printf, the subtree is listed with parallel SFTP listdir_attr requests.
+    '''
+    # type mode size uid gid atime mtime, relative path, link target
+    FIND_FORMAT = '%y %m %s %U %G %A@ %T@\\0%P\\0%l\\0'
+    # directories that cannot be listed are reported with type D, so no readdir entry is saved for them
+    FIND_UNREADABLE_FORMAT = 'D' + FIND_FORMAT[2:]
+    TYPES = {
+        'f': stat.S_IFREG, 'd': stat.S_IFDIR, 'D': stat.S_IFDIR, 'l': stat.S_IFLNK,
+        'p': stat.S_IFIFO, 's': stat.S_IFSOCK, 'c': stat.S_IFCHR, 'b': stat.S_IFBLK,
+    }
+    READ_SIZE = 65536
+    WORKERS = 8
+
+    def __init__(self):
+        self.log = getLogger(log.METADATA)
+        self.sequence: int = None # readdir_sequence when the snapshot started
+
+    def run(self, path: str):
+        try:
+            self.log.debug('-> snapshot: %s', path)
+            metrics.counts.incr('snapshot')
+            if not sftp.manager.isConnected():
+                self.log.debug('<- snapshot: %s offline', path)
+                return
+            self.sequence = metadata.cache.readdir_sequence() # listings of directories changed since are not saved
+            count = self._find(path)
+            if count == None:
+                metrics.counts.incr('snapshot_listdir')
+                count = self._listdir(path)
+            metrics.counts.incr('snapshot_entries', count)
+            self.log.debug('<- snapshot: %s %d', path, count)
+        except Exception as e:
+            self.log.error('<- snapshot: %s %s', path, e)
+            metrics.counts.incr('snapshot_except')
+        finally:
+            # the snapshot thread is gone, close its connection
+            threadId = threading.get_native_id()
+            if threadId in sftp.manager.connections:
+                sftp.manager.sftpClose(threadId)
+
+    def _find(self, path: str) -> int | None:
+        '''
+        Snapshot the subtree with one remote find command.  Returns None when the command cannot be used.
+        '''
+        try:
+            sshClient = sftp.manager.sshClient()
+            if sshClient == None:
+                return None
+            command = 'cd {} && find {} -depth \\( -type d ! \\( -readable -executable \\) -printf {} \\) -o -printf {} 2>/dev/null'.format(
+                shlex.quote(sftp.manager.sftp().getcwd() or '.'),
+                shlex.quote(sftp.fixPath(path) or '.'),
+                shlex.quote(Snapshot.FIND_UNREADABLE_FORMAT),
+                shlex.quote(Snapshot.FIND_FORMAT))
+            stdin, stdout, stderr = sshClient.exec_command(command)
+            stdin.close()
+        except paramiko.SSHException as e:
+            self.log.debug('snapshot: exec failed %s', e)
+            return None
+
+        count = self._parseFind(path, stdout)
+        status = stdout.channel.recv_exit_status()
+        if status != 0 and count == 0:
+            self.log.debug('snapshot: find exit status %d', status)
+            return None
+        return count
+
+    def _parseFind(self, path: str, stdout) -> int:
+        # -depth lists the entries of a directory before the directory itself, so the names of a directory are
+        # complete when the directory is reached, and only directories on the current path are held in memory.
+        children: dict[str, list[str]] = dict()
+        fields: list[bytes] = []
+        rest = b''
+        count = 0
+        while True:
+            buf = stdout.read(Snapshot.READ_SIZE)
+            if len(buf) == 0:
+                break
+            fields += (rest + buf).split(b'\0')
+            rest = fields.pop()
+            while len(fields) >= 3:
+                header, relPath, link = [field.decode(metadata.Metadata.ENCODING, 'surrogateescape') for field in fields[0:3]]
+                del fields[0:3]
+                self._saveFindEntry(path, header, relPath, link, children)
+                count += 1
+        return count
+
+    def _saveFindEntry(self, path: str, header: str, relPath: str, link: str, children: dict[str, list[str]]):
+        fileType, mode, size, uid, gid, atime, mtime = header.split(' ')
+        d = {
+            'st_atime': int(float(atime)),
+            'st_gid': int(gid),
+            'st_mode': Snapshot.TYPES.get(fileType, 0) | int(mode, 8),
+            'st_mtime': int(float(mtime)),
+            'st_size': int(size),
+            'st_uid': int(uid),
+        }
+        fusePath = os.path.join(path, relPath) if relPath != '' else path
+        metadata.cache.getattr_save(fusePath, d)
+        if fileType == 'l':
+            metadata.cache.readlink_save(fusePath, link)
+        elif fileType == 'd':
+            metadata.cache.readdir_save(fusePath, children.pop(relPath, []), self.sequence)
+        elif fileType == 'D':
+            children.pop(relPath, None)
+        if relPath != '':
+            parent, name = os.path.split(relPath)
+            children.setdefault(parent, []).append(name)
+
+    def _listdir(self, path: str) -> int:
+        '''
+        Snapshot the subtree with parallel SFTP listdir_attr requests, one directory per request.
+        '''
+        metadata.cache.getattr_save(path, metadata.getattrDict(sftp.manager.sftp().lstat(sftp.fixPath(path))))
+        threadIds: set[int] = set()
+        count = 0
+        try:
+            with ThreadPoolExecutor(max_workers=Snapshot.WORKERS) as executor:
+                futures = {executor.submit(self._listdirOne, path, threadIds)}
+                while len(futures) > 0:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        subdirs, n = future.result()
+                        count += n
+                        futures |= {executor.submit(self._listdirOne, subdir, threadIds) for subdir in subdirs}
+        finally:
+            # the worker threads are gone, close their connections
+            for threadId in threadIds:
+                if threadId in sftp.manager.connections:
+                    sftp.manager.sftpClose(threadId)
+        return count
+
+    def _listdirOne(self, path: str, threadIds: set[int]) -> tuple[list[str], int]:
+        threadIds.add(threading.get_native_id())
+        try:
+            attrs = sftp.manager.sftp().listdir_attr(sftp.fixPath(path))
+        except IOError as e:
+            self.log.debug('snapshot: listdir_attr %s %s', path, e)
+            return [], 0
+        subdirs: list[str] = []
+        for attr in attrs:
+            p = os.path.join(path, attr.filename)
+            metadata.cache.getattr_save(p, metadata.getattrDict(attr))
+            if stat.S_ISDIR(attr.st_mode):
+                subdirs.append(p)
+            elif stat.S_ISLNK(attr.st_mode):
+                metadata.cache.readlink_save(p, sftp.manager.sftp().readlink(sftp.fixPath(p)))
+        metadata.cache.readdir_save(path, [attr.filename for attr in attrs], self.sequence)
+        return subdirs, len(attrs)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import errno
+import itertools
 from logging import getLogger
 import os
 from pathlib import Path
+import threading
 
 import getpass
 
@@ -13,8 +15,13 @@ from sshfs_offline import sftp
 from fuse import FUSE, FuseOSError, Operations
 
 from sshfs_offline.cache import data
+from sshfs_offline.cache import inspector
 from sshfs_offline.cache import metadata
+from sshfs_offline.cache import snapshot
+from sshfs_offline import daemon
+from sshfs_offline import kernel
 from sshfs_offline import log
+from sshfs_offline import trace
 
 class Main(Operations):
     '''
@@ -23,8 +30,9 @@ class Main(Operations):
 
     HOME_DIR = str(Path.home())
     CACHE_TIMEOUT = 5 * 60
+    NEGATIVE_TIMEOUT = 1 # seconds the kernel caches a missing path, which may only be missing from the offline cache
                         
-    def __init__(self, args): 
+    def __init__(self, args, manager: sftp.SFTPManager=None): 
         self.debug = args.debug       
         host = args.host
         user = args.user
@@ -33,21 +41,38 @@ class Main(Operations):
         else:
             remotedir = args.remotedir
         port = args.port
+        self.snapshots = ['/' + sftp.fixPath(path).strip('/') for path in args.snapshot or []]
                
         self.log = getLogger(log.MAIN)
-       
+        self.kernelCache = kernel.KernelCache()
+
         metrics.counts = metrics.Metrics()
-        sftp.manager = sftp.SFTPManager(host, user, remotedir, port) 
+        if manager == None:
+            manager = sftp.SFTPManager(host, user, remotedir, port, args.blocksize)
+        sftp.manager = manager
         metadata.cache = metadata.Metadata(host, remotedir, args.cachetimeout)
-        data.cache = data.Data(host, remotedir)
+        data.cache = data.Data(host, remotedir, args.blocksize, args.stripes, args.stripeminsize, args.ramcache * 1024 * 1024)
 
         sftp.manager.sftp() # verify connection to host
 
+        self.tracer: trace.Recorder = None
+        if getattr(args, 'trace', None) != None:
+            self.tracer = trace.Recorder(args.trace, dict(host=host, user=user, port=port, remotedir=remotedir,
+                cachetimeout=args.cachetimeout, blocksize=args.blocksize, stripes=args.stripes,
+                stripeminsize=args.stripeminsize, ramcache=args.ramcache))
+
+    def __call__(self, op, *args):
+        if self.tracer == None:
+            return super().__call__(op, *args)
+        return self.tracer.record(op, args, super().__call__)
+
     def init(self, path):
         metrics.counts.incr('init')
         metrics.counts.start()
         log.Log().setupConfig(self.debug)
         sftp.manager.startKeepalive()        
+        for path in self.snapshots:
+            threading.Thread(target=snapshot.Snapshot().run, args=(path,), daemon=True).start()
          
     def chmod(self, path, mode): 
         try: 
@@ -73,15 +98,18 @@ class Main(Operations):
             metrics.counts.incr('chown_except') 
             raise e
         
-    def create(self, path, mode):  
+    def create(self, path, mode, fi=None):
         try:
             self.log.debug('-> create: %s %s', path, mode)  
             metrics.counts.incr('create')     
             metadata.cache.deleteMetadata(path)
-            metadata.cache.deleteParentMetadata(path)
             f = sftp.manager.sftp().open(sftp.fixPath(path), 'w')
             f.chmod(mode)
+            st = f.stat()
             f.close()
+            data.cache.create(path)
+            metadata.cache.getattr_save(path, metadata.getattrDict(st), deleteStale=False)
+            metadata.cache.addParentEntry(path)
             self.log.debug('<- create: %s', path)             
             return 0
         except Exception as e:
@@ -102,6 +130,8 @@ class Main(Operations):
         finally:
             metrics.counts.stop()
             sftp.manager.stop()
+            if self.tracer != None:
+                self.tracer.close()
 
     def getattr(self, path, fh=None):
         try:
@@ -114,6 +144,15 @@ class Main(Operations):
                 else:
                     self.log.debug('<- getattr: %s', path)
                     return d # cache hit
+
+            if path != '/':
+                parent, name = os.path.split(path)
+                if metadata.cache.readdir_contains(parent, name) == False:
+                    metrics.counts.incr('getattr_negative_hit')
+                    raise FuseOSError(errno.ENOENT) # not in the parent's cached directory entries
+            if sftp.manager.offline:
+                metrics.counts.incr('getattr_offline_miss')
+                raise FuseOSError(errno.ENOENT) # not cached
             
             try:
                 st = sftp.manager.sftp().lstat(sftp.fixPath(path))            
@@ -121,8 +160,7 @@ class Main(Operations):
                 metadata.cache.getattr_save(path, {}) # negative cache entry          
                 raise FuseOSError(errno.ENOENT)
 
-            d = dict((key, getattr(st, key)) for key in (
-                'st_atime', 'st_gid', 'st_mode', 'st_mtime', 'st_size', 'st_uid'))
+            d = metadata.getattrDict(st)
             metadata.cache.getattr_save(path, d)
             self.log.debug('<- getattr: %s %s', path, d)
             return d
@@ -152,14 +190,30 @@ class Main(Operations):
             self.log.debug('-> mkdir: %s %s', path, mode) 
             metrics.counts.incr('mkdir')      
             metadata.cache.deleteMetadata(path)
-            metadata.cache.deleteParentMetadata(path)
             sftp.manager.sftp().mkdir(sftp.fixPath(path), mode)
+            metadata.cache.addParentEntry(path)
             self.log.debug('<- mkdir: %s', path)
         except Exception as e:
             self.log.error('<- mkdir: %s %s', path, mode) 
             metrics.counts.incr('mkdir_except')  
             raise e
 
+    def open(self, path, fi):
+        try:
+            self.log.debug('-> open: %s', path)
+            metrics.counts.incr('open')
+            st = self.getattr(path)
+            if self.kernelCache.keep(path, st['st_mtime']):
+                fi.keep_cache = 1 # mtime unchanged since last open, keep kernel page cache
+                metrics.counts.incr('open_keep_cache')
+            self.log.debug('<- open: %s keep_cache=%d', path, fi.keep_cache)
+            return 0
+        except Exception as e:
+            if not isinstance(e, OSError) or e.errno != errno.ENOENT:
+                self.log.error('<- open: %s %s', path, e)
+                metrics.counts.incr('open_except')
+            raise e
+
     def read(self, path, size, offset, fh):  
         try:
             self.log.debug('-> read: %s size=%d offset=%d', path, size, offset)
@@ -179,15 +233,12 @@ class Main(Operations):
             self.log.debug('-> readdir: %s', path)
             metrics.counts.incr('readdir')
             s = metadata.cache.readdir(path)
-            if s != None:
-                self.log.debug('<- readdir: %s %d', path, len(s))
-                return s
-            s = ['.', '..'] + [name
-                                for name in sftp.manager.sftp().listdir(sftp.fixPath(path))]
-            metadata.cache.readdir_save(path, s)        
-            s = metadata.cache.readdir(path)
-            self.log.debug('<- readdir: %s %d', path, len(s))
-            return s
+            if s == None:
+                sequence = metadata.cache.readdir_sequence()
+                s = sftp.manager.sftp().listdir(sftp.fixPath(path))
+                metadata.cache.readdir_save(path, s, sequence)
+            self.log.debug('<- readdir: %s', path)
+            return itertools.chain(['.', '..'], s)
         except Exception as e:
             self.log.error('<- readdir: %s', path)
             metrics.counts.incr('readdir_except') 
@@ -213,8 +264,12 @@ class Main(Operations):
         try:
             self.log.debug('-> rename: %s %s', old, new) 
             metrics.counts.incr('rename')       
-            metadata.cache.deleteMetadata(old)
+            self.kernelCache.invalidateTree(old)
+            self.kernelCache.invalidateTree(new)
             sftp.manager.sftp().rename(sftp.fixPath(old), sftp.fixPath(new))
+            # keep the cache, it is still valid for the new path
+            data.cache.rename(old, new)
+            metadata.cache.rename(old, new)
             self.log.debug('<- rename: %s %s', old, new)
         except Exception as e:
             self.log.error('<- rename: %s %s', old, new) 
@@ -226,8 +281,8 @@ class Main(Operations):
             self.log.debug('-> rmdir: %s', path)   
             metrics.counts.incr('rmdir')  
             metadata.cache.deleteMetadata(path)
-            metadata.cache.deleteParentMetadata(path)
             sftp.manager.sftp().rmdir(sftp.fixPath(path))
+            metadata.cache.removeParentEntry(path)
             self.log.debug('<- rmdir: %s', path)    
         except Exception as e:
             self.log.error('<- rmdir: %s', path)  
@@ -239,6 +294,8 @@ class Main(Operations):
             self.log.debug('-> symlink: %s %s', target, source)   
             metrics.counts.incr('symlink')        
             sftp.manager.sftp().symlink(sftp.fixPath(source), sftp.fixPath(target))
+            metadata.cache.deleteMetadata(target)
+            metadata.cache.addParentEntry(target)
             self.log.debug('<- symlink: %s %s', target, source)     
         except Exception as e:
             self.log.error('<- symlink: %s %s', target, source) 
@@ -249,9 +306,12 @@ class Main(Operations):
         try:
             self.log.debug('-> truncate: %s %d', path, length)  
             metrics.counts.incr('truncate')         
-            metadata.cache.deleteMetadata(path)
-            data.cache.deleteStaleFile(path)
-            sftp.manager.sftp().truncate(sftp.fixPath(path), length)
+            self.kernelCache.invalidate(path)
+            with data.cache.writeLock(path):
+                sftp.manager.sftp().truncate(sftp.fixPath(path), length)
+                data.cache.truncate(path, length)
+            st = sftp.manager.sftp().lstat(sftp.fixPath(path))
+            metadata.cache.getattr_save(path, metadata.getattrDict(st), deleteStale=False)
             self.log.debug('<- truncate: %s', path)   
         except Exception as e:
             self.log.error('<- truncate: %s %d', path, length)  
@@ -262,10 +322,11 @@ class Main(Operations):
         try: 
             self.log.debug('-> unlink: %s', path)    
             metrics.counts.incr('unlink')     
+            self.kernelCache.invalidate(path)
             metadata.cache.deleteMetadata(path)
-            metadata.cache.deleteParentMetadata(path)
             data.cache.deleteStaleFile(path)
             sftp.manager.sftp().unlink(sftp.fixPath(path))
+            metadata.cache.removeParentEntry(path)
             self.log.debug('<- unlink: %s', path)    
         except Exception as e:
             self.log.error('<- unlink: %s', path)   
@@ -276,9 +337,16 @@ class Main(Operations):
         try:
             self.log.debug('-> utimens: %s', path) 
             metrics.counts.incr('utimens')   
-            metadata.cache.deleteMetadata(path)
-            data.cache.deleteStaleFile(path)
+            self.kernelCache.invalidate(path)
             sftp.manager.sftp().utime(sftp.fixPath(path), times)
+            # the file content is unchanged, keep the cached data
+            data.cache.touch(path)
+            d = metadata.cache.getattr(path)
+            if times != None and d != None and d != {}:
+                d['st_atime'], d['st_mtime'] = times
+                metadata.cache.getattr_save(path, d, deleteStale=False)
+            else:
+                metadata.cache.deleteMetadata(path, [metadata.Metadata.GETATTR])
             self.log.debug('<- utimens: %s', path)   
         except Exception as e:
             self.log.error('<- utimens: %s', path) 
@@ -289,13 +357,18 @@ class Main(Operations):
         try:       
             self.log.debug('-> write: %s size=%d offset=%d', path, len(buf), offset)
             metrics.counts.incr('write')
-            metadata.cache.deleteMetadata(path)  
-            data.cache.deleteStaleFile(path)
+            self.kernelCache.invalidate(path)
             #self.log.debug('write: write to remote file %s %d', path, offset)
-            with sftp.manager.sftp().open(sftp.fixPath(path), 'r+') as file:
-                file.seek(offset, 0)
-                file.write(buf)                
-                file.close()
+            with data.cache.writeLock(path):
+                with sftp.manager.sftp().open(sftp.fixPath(path), 'r+') as file:
+                    file.seek(offset, 0)
+                    file.write(buf)
+                    file.flush()
+                    st = file.stat()
+                    file.close()
+                # write through to the cache, so reading back what was written is a cache hit
+                data.cache.write(path, buf, offset, st.st_size)
+            metadata.cache.getattr_save(path, metadata.getattrDict(st), deleteStale=False)
             self.log.debug('<- write: %s %d', path, len(buf))
             return len(buf)
         except Exception as e:
@@ -303,8 +376,179 @@ class Main(Operations):
             metrics.counts.incr('write_except') 
             raise e           
 
+class Frontend(Operations):
+    '''
+    FUSE frontend of a mount that is served by the shared cache daemon of the host.  The paths are prefixed with the
+    remote directory of the mount and forwarded to the daemon.  The kernel page cache is per mount, so it is managed
+    here.
+    '''
+
+    def __init__(self, args):
+        self.debug = args.debug
+        self.log = getLogger(log.MAIN)
+        self.kernelCache = kernel.KernelCache()
+
+        self.client = daemon.Client(daemon.name(args.host, args.port, args.user))
+        self.client.start([args.host, '--port', str(args.port), '--user', args.user,
+                           '--cachetimeout', str(args.cachetimeout), '--blocksize', str(args.blocksize),
+                           '--stripes', str(args.stripes), '--stripeminsize', str(args.stripeminsize)]
+                          + (['--debug'] if args.debug else []))
+
+        if args.remotedir == None:
+            remotedir = os.path.join('/home', args.user)
+        else:
+            # the daemon works from the remote root directory, it resolves a relative directory in the login directory
+            remotedir = args.remotedir
+            if remotedir.startswith('~'):
+                remotedir = remotedir[1:].lstrip('/') or '.'
+            try:
+                remotedir = self.client.call('resolve', remotedir)
+            except FuseOSError as e:
+                print('Cannot resolve --remotedir {} on host {}: {}'.format(args.remotedir, args.host, os.strerror(e.errno)))
+                exit(1)
+        self.remotedir = remotedir.rstrip('/')
+        self.snapshots = [self._path('/' + sftp.fixPath(path).strip('/')) for path in args.snapshot or []]
+
+        try:
+            self.client.call('getattr', self._path('/'))
+        except FuseOSError as e:
+            if e.errno == errno.ENOENT:
+                print('--remotedir '+remotedir+' not found on host '+args.host)
+                exit(1)
+
+    def _path(self, path: str) -> str:
+        return (self.remotedir + path).rstrip('/') or '/'
+
+    def init(self, path):
+        log.Log().setupConfig(self.debug)
+        for path in self.snapshots:
+            self.client.call('snapshot', path)
+
+    def destroy(self, path):
+        self.client.close()
+
+    def chmod(self, path, mode):
+        self.client.call('chmod', self._path(path), mode)
+
+    def chown(self, path, uid, gid):
+        self.client.call('chown', self._path(path), uid, gid)
+
+    def create(self, path, mode, fi=None):
+        return self.client.call('create', self._path(path), mode)
+
+    def getattr(self, path, fh=None):
+        return self.client.call('getattr', self._path(path))
+
+    def statfs(self, path):
+        return self.client.call('statfs', self._path(path))
+
+    def mkdir(self, path, mode):
+        self.client.call('mkdir', self._path(path), mode)
+
+    def open(self, path, fi):
+        st = self.getattr(path)
+        if self.kernelCache.keep(path, st['st_mtime']):
+            fi.keep_cache = 1 # mtime unchanged since last open, keep kernel page cache
+        self.log.debug('<- open: %s keep_cache=%d', path, fi.keep_cache)
+        return 0
+
+    def read(self, path, size, offset, fh):
+        return self.client.read(self._path(path), size, offset)
+
+    def readdir(self, path, fh):
+        return self.client.call('readdir', self._path(path), None)
+
+    def readlink(self, path):
+        return self.client.call('readlink', self._path(path))
+
+    def rename(self, old, new):
+        self.kernelCache.invalidateTree(old)
+        self.kernelCache.invalidateTree(new)
+        self.client.call('rename', self._path(old), self._path(new))
+
+    def rmdir(self, path):
+        self.client.call('rmdir', self._path(path))
+
+    def symlink(self, target, source):
+        self.client.call('symlink', self._path(target), source)
+
+    def truncate(self, path, length, fh=None):
+        self.kernelCache.invalidate(path)
+        self.client.call('truncate', self._path(path), length)
+
+    def unlink(self, path):
+        self.kernelCache.invalidate(path)
+        self.client.call('unlink', self._path(path))
+
+    def utimens(self, path, times=None):
+        self.kernelCache.invalidate(path)
+        self.client.call('utimens', self._path(path), times)
+
+    def write(self, path, buf, offset, fh):
+        self.kernelCache.invalidate(path)
+        return self.client.call('write', self._path(path), buf, offset, None)
+
+def blockSize(value: str) -> int:
+    '''
+    Argument type of --blocksize, a power of two from 4KB to 1MB, the range of the FUSE read/write size.
+    '''
+    import argparse
+    try:
+        size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: {!r}'.format(value))
+    if size < 4096 or size > 1048576 or size & (size - 1) != 0:
+        raise argparse.ArgumentTypeError('{} is not a power of two from 4096 to 1048576'.format(size))
+    return size
+
+def daemonMain(argv: list[str]):
+    '''
+    Run the shared cache daemon of a host.  It is started by the first mount of the host with --daemon.
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(prog='sshfs-offline daemon')
+    parser.add_argument('host', help='remote host name')
+    parser.add_argument('-p', '--port', help='port number (default=22)', default=22)
+    parser.add_argument('-u', '--user', help='user on remote host', default=getpass.getuser())
+    parser.add_argument('--debug', help='run in debug mode', action='store_true')
+    parser.add_argument('--cachetimeout', type=int, default=Main.CACHE_TIMEOUT)
+    parser.add_argument('--blocksize', type=blockSize, default=sftp.BLOCK_SIZE)
+    parser.add_argument('--stripes', type=int, default=data.Data.STRIPES)
+    parser.add_argument('--stripeminsize', type=int, default=data.Data.STRIPE_MIN_SIZE)
+    args = parser.parse_args(argv)
+    args.remotedir = '/' # the daemon serves every remote directory of the host
+    args.snapshot = None
+    args.ramcache = 0 # the frontends read the data files directly
+    args.trace = None
+
+    name = daemon.name(args.host, args.port, args.user)
+    os.makedirs(daemon.DAEMON_DIR, mode=0o700, exist_ok=True)
+    log.Log(os.path.join('daemon', name + '.')).setupConfig(debug=args.debug)
+
+    ops = Main(args)
+    metrics.counts.start()
+    sftp.manager.startKeepalive()
+    try:
+        daemon.Daemon(ops, name).serve()
+    except Exception as e:
+        getLogger(log.DAEMON).error('daemon %s: %s', name, e)
+    metrics.counts.stop()
+    sftp.manager.stop()
+    os._exit(0) # the prefetch thread does not stop
+
 def main():
     import argparse
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'cache':
+        inspector.main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'trace':
+        trace.main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        daemonMain(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser()  
     parser.description = 'To unmount use: fusermount -u mountpoint'
     parser.add_argument('host', help='remote host name')
@@ -314,12 +558,26 @@ def main():
     parser.add_argument('-d', '--remotedir', help='directory on remote host (eg, ~/)')
     parser.add_argument('--debug', help='run in debug mode', action='store_true')
     parser.add_argument('--cachetimeout', type=int, help='duration in seconds to keep metadata cached (default is 5 minutes)', default=Main.CACHE_TIMEOUT)
+    parser.add_argument('--blocksize', type=blockSize, help='FUSE read/write size and cache fetch size in bytes (default=131072)', default=sftp.BLOCK_SIZE)
+    parser.add_argument('--stripes', type=int, help='number of SSH connections to fetch large files with in parallel (default=4)', default=data.Data.STRIPES)
+    parser.add_argument('--stripeminsize', type=int, help='minimum file size in bytes to fetch with parallel stripes (default=64MB)', default=data.Data.STRIPE_MIN_SIZE)
+    parser.add_argument('--ramcache', type=int, metavar='MB', help='size of the RAM cache of hot data blocks in MB (default=0, disabled)', default=0)
+    parser.add_argument('--daemon', help='share the cache, connections and prefetching with other mounts of the host through a cache daemon', action='store_true')
+    parser.add_argument('--trace', metavar='FILE', help='record the operations to a trace file, for sshfs-offline trace stats|replay')
+    parser.add_argument('--snapshot', action='append', metavar='SUBDIR', help='cache the metadata of the SUBDIR tree (relative to the mountpoint) when mounted, may be repeated')
 
     args = parser.parse_args()   
+    if args.daemon and args.ramcache > 0:
+        parser.error('--ramcache cannot be used with --daemon, the frontends read the cached data files directly')
+    if args.daemon and args.trace != None:
+        parser.error('--trace cannot be used with --daemon')
 
     log.Log().setupConfig(debug=args.debug)            
     
-    main = Main(args)    
+    if args.daemon:
+        main = Frontend(args)
+    else:
+        main = Main(args)    
 
     #print(args.host, args.login)
     #exit()
@@ -330,10 +588,14 @@ def main():
             args.mountpoint,
             foreground=args.debug,
             nothreads=False,
+            raw_fi=True, # open() sets keep_cache in fuse_file_info
+            attr_timeout=args.cachetimeout, # kernel attribute and entry caching follow the metadata cache timeout
+            entry_timeout=args.cachetimeout,
+            negative_timeout=min(args.cachetimeout, Main.NEGATIVE_TIMEOUT),
             allow_other=True,
             big_writes=True,
-            max_read=sftp.BLOCK_SIZE, # Set max read size (e.g., 128KB)
-            max_write=sftp.BLOCK_SIZE, # Set max write size (e.g., 128KB)
+            max_read=args.blocksize, # Set max read size (e.g., 128KB)
+            max_write=args.blocksize, # Set max write size (e.g., 128KB)
         )
     except Exception as e:
         pass
@@ -0,0 +1,289 @@
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fcntl
+from logging import getLogger
+import os
+from pathlib import Path
+import pickle
+import posixpath
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from fuse import FuseOSError, Operations
+
+from sshfs_offline import metrics
+from sshfs_offline import sftp
+from sshfs_offline import log
+from sshfs_offline.cache import data
+from sshfs_offline.cache import snapshot
+
+DAEMON_DIR = os.path.join(Path.home(), '.sshfs-offline', 'daemon')
+HEADER = struct.Struct('!I') # length of the pickled frame that follows
+
+def name(host: str, port: int, user: str) -> str:
+    return '{}@{}:{}'.format(user, host, port)
+
+def socketPath(name: str) -> str:
+    return os.path.join(DAEMON_DIR, name + '.sock')
+
+def _send(sock: socket.socket, obj, fds: list[int]=[]):
+    buf = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    frame = HEADER.pack(len(buf)) + buf
+    if len(fds) > 0:
+        # the file descriptors ride on the first bytes of the frame
+        sent = socket.send_fds(sock, [frame], fds)
+        frame = frame[sent:]
+    sock.sendall(frame)
+
+def _recv(sock: socket.socket) -> tuple[object, list[int]]:
+    header = b''
+    fds: list[int] = []
+    while len(header) < HEADER.size:
+        buf, newFds, flags, addr = socket.recv_fds(sock, HEADER.size - len(header), 1)
+        if len(buf) == 0:
+            raise EOFError()
+        header += buf
+        fds += newFds
+    size = HEADER.unpack(header)[0]
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if len(chunk) == 0:
+            raise EOFError()
+        buf += chunk
+    return pickle.loads(buf), fds
+
+class Daemon:
+    '''
+    Shared cache daemon of a host.  It owns the SSH connections, the metadata and data caches and the prefetch
+    threads, and serves the FUSE frontends of several mounts of the host over a unix socket.  The cache is rooted at
+    the remote root directory, and the frontends prefix their paths with the remote directory of the mount.  Reads
+    are not copied through the socket, the frontend is passed the file descriptor of the cached data file.
+    '''
+    WORKERS = 16
+    IDLE_TIMEOUT = 60 # seconds without a frontend before the daemon exits
+    OPS = ('chmod', 'chown', 'create', 'getattr', 'statfs', 'mkdir', 'readdir', 'readlink', 'rename', 'rmdir',
+           'symlink', 'truncate', 'unlink', 'utimens', 'write')
+
+    def __init__(self, ops: Operations, name: str):
+        self.log = getLogger(log.DAEMON)
+        self.ops = ops
+        self.name = name
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.idleSince = time.time()
+        # the worker threads are kept, so each one keeps its own SSH connection
+        self.pool = ThreadPoolExecutor(max_workers=Daemon.WORKERS, thread_name_prefix='daemon')
+        self.server: socketserver.ThreadingUnixStreamServer = None
+
+    def serve(self):
+        '''
+        Serve the frontends until there have been none for IDLE_TIMEOUT seconds.  Only one daemon runs per host, the
+        daemon holds a lock on its lock file while it is running.
+        '''
+        os.makedirs(DAEMON_DIR, mode=0o700, exist_ok=True)
+        lockFile = open(os.path.join(DAEMON_DIR, self.name + '.lock'), 'w')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.log.info('daemon %s is already running', self.name)
+            return
+
+        path = socketPath(self.name)
+        if os.path.exists(path):
+            os.unlink(path) # left by a daemon that did not exit cleanly
+
+        daemon = self
+        class Handler(socketserver.BaseRequestHandler):
+            def setup(self):
+                daemon._attach(1)
+            def handle(self):
+                daemon._handle(self.request)
+            def finish(self):
+                daemon._attach(-1)
+
+        oldUmask = os.umask(0o177) # the socket is only accessible by the user
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        finally:
+            os.umask(oldUmask)
+        self.server.daemon_threads = True
+
+        threading.Thread(target=self.idleThread, daemon=True).start()
+        self.log.info('daemon %s started', self.name)
+        metrics.counts.incr('daemon_start')
+        try:
+            self.server.serve_forever()
+        finally:
+            os.unlink(path)
+            self.server.server_close()
+            self.log.info('daemon %s stopped', self.name)
+            metrics.counts.incr('daemon_stop')
+            lockFile.close()
+
+    def _attach(self, n: int):
+        with self.lock:
+            self.clients += n
+            self.idleSince = time.time()
+        metrics.counts.incr('daemon_connect' if n > 0 else 'daemon_disconnect')
+
+    def _handle(self, sock: socket.socket):
+        while True:
+            try:
+                op, args = _recv(sock)[0]
+            except (EOFError, ConnectionError):
+                break
+            fds: list[int] = []
+            try:
+                if op == 'read':
+                    fds = [self.pool.submit(self.read, *args).result()]
+                    reply = ('ok', None)
+                elif op == 'resolve':
+                    reply = ('ok', self.pool.submit(self.resolve, *args).result())
+                elif op == 'snapshot':
+                    threading.Thread(target=snapshot.Snapshot().run, args=args, daemon=True).start()
+                    reply = ('ok', None)
+                elif op in Daemon.OPS:
+                    result = self.pool.submit(getattr(self.ops, op), *args).result()
+                    if op == 'readdir':
+                        result = list(result)
+                    reply = ('ok', result)
+                else:
+                    reply = ('err', errno.ENOSYS)
+            except OSError as e:
+                reply = ('err', e.errno or errno.EIO)
+            except Exception as e:
+                self.log.error('%s: %s %s', op, args[:1], e)
+                metrics.counts.incr('daemon_except')
+                reply = ('err', errno.EIO)
+            try:
+                _send(sock, reply, fds)
+            except ConnectionError:
+                break
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def resolve(self, path: str) -> str:
+        '''
+        The absolute remote directory of a mount.  A relative directory is in the login directory of the user, which is
+        remembered for mounts while the host is offline.
+        '''
+        homePath = os.path.join(DAEMON_DIR, self.name + '.home')
+        if sftp.manager.isConnected() and sftp.manager.home != None:
+            home = sftp.manager.home
+            with open(homePath, 'w') as file:
+                file.write(home)
+        elif os.path.exists(homePath):
+            with open(homePath, 'r') as file:
+                home = file.read()
+        else:
+            raise FuseOSError(errno.ENETDOWN)
+        return posixpath.normpath(posixpath.join(home, path))
+
+    def read(self, path, size, offset) -> int:
+        try:
+            self.log.debug('-> read: %s size=%d offset=%d', path, size, offset)
+            metrics.counts.incr('read')
+            fd = data.cache.open(path, size, offset)
+            self.log.debug('<- read: %s fd=%d', path, fd)
+            return fd
+        except Exception as e:
+            self.log.error('<- read: %s %s %d', path, size, offset)
+            metrics.counts.incr('read_except')
+            raise e
+
+    def idleThread(self):
+        while True:
+            time.sleep(1)
+            with self.lock:
+                idle = self.clients == 0 and time.time() - self.idleSince > Daemon.IDLE_TIMEOUT
+            if idle:
+                self.log.info('daemon %s idle', self.name)
+                self.server.shutdown()
+                break
+
+class Client:
+    '''
+    Connection of a FUSE frontend to the cache daemon.  Each FUSE thread has its own socket, so the requests of a
+    mount are served in parallel.
+    '''
+    def __init__(self, name: str):
+        self.log = getLogger(log.DAEMON)
+        self.name = name
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.socks: list[socket.socket] = []
+
+    def start(self, argv: list[str]):
+        '''
+        Connect to the daemon, and start it with the sshfs-offline daemon arguments when it is not running.
+        '''
+        if self._connect():
+            return
+        self.log.debug('start: %s', self.name)
+        process = subprocess.Popen([sys.executable, '-m', 'sshfs_offline.cli', 'daemon'] + argv,
+                                   start_new_session=True) # the daemon outlives the mount
+        while not self._connect():
+            if process.poll() not in (None, 0):
+                print('Cannot start the cache daemon for ' + self.name)
+                exit(1)
+            time.sleep(0.1)
+
+    def _connect(self) -> bool:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socketPath(self.name))
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            return False
+        self.local.sock = sock
+        with self.lock:
+            self.socks.append(sock)
+        return True
+
+    def _sock(self) -> socket.socket:
+        if getattr(self.local, 'sock', None) == None:
+            if not self._connect():
+                raise FuseOSError(errno.ENOTCONN) # the daemon exited
+        return self.local.sock
+
+    def call(self, op: str, *args):
+        sock = self._sock()
+        try:
+            _send(sock, (op, args))
+            (status, result), fds = _recv(sock)
+        except (EOFError, ConnectionError):
+            self._close(sock)
+            raise FuseOSError(errno.ENOTCONN)
+        if status == 'err':
+            raise FuseOSError(result)
+        if op == 'read':
+            return fds[0]
+        return result
+
+    def read(self, path: str, size: int, offset: int) -> bytes:
+        fd = self.call('read', path, size, offset)
+        try:
+            return os.pread(fd, size, offset)
+        finally:
+            os.close(fd)
+
+    def _close(self, sock: socket.socket):
+        self.local.sock = None
+        with self.lock:
+            if sock in self.socks:
+                self.socks.remove(sock)
+        sock.close()
+
+    def close(self):
+        with self.lock:
+            socks = self.socks
+            self.socks = []
+        for sock in socks:
+            sock.close()
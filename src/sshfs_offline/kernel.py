@@ -0,0 +1,33 @@
+from collections import OrderedDict
+import threading
+
+class KernelCache:
+    '''
+    Decides when the kernel may keep its page cache for a file across opens.  The page cache is kept when the
+    file's mtime has not changed since the previous open, and is dropped on the next open after the path is
+    invalidated.  Only the most recently opened paths are remembered, a path that was forgotten drops its page cache
+    on the next open.
+    '''
+    MAX_PATHS = 65536
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mtimes: OrderedDict[str, float] = OrderedDict() # least recently opened first
+
+    def keep(self, path: str, mtime: float) -> bool:
+        with self.lock:
+            prevMtime = self.mtimes.pop(path, None)
+            self.mtimes[path] = mtime
+            if len(self.mtimes) > KernelCache.MAX_PATHS:
+                self.mtimes.popitem(last=False)
+        return prevMtime != None and prevMtime == mtime
+
+    def invalidate(self, path: str):
+        with self.lock:
+            self.mtimes.pop(path, None)
+
+    def invalidateTree(self, path: str):
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for p in [p for p in self.mtimes if p == path or p.startswith(prefix)]:
+                self.mtimes.pop(p)
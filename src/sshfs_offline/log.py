@@ -4,6 +4,7 @@ import os
 from pathlib import Path
 
 MAIN        = 'main    '
+DAEMON      = 'daemon  '
 SFTP        = 'sftp    '
 METADATA    = 'metadata'
 DATA        = 'data    '
@@ -13,8 +14,9 @@ FUSE        = 'fuse'
 PARAMIKO    = 'paramiko'
 
 class Log:
-    def __init__(self):
+    def __init__(self, prefix: str=''):
         self.logDir = os.path.join(Path.home(), '.sshfs-offline')
+        self.prefix = prefix # the cache daemon logs to its own files
         if not os.path.exists(self.logDir):
             os.makedirs(self.logDir)
         self.formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s %(message)s')
@@ -32,9 +34,9 @@ class Log:
             ) 
                 
         # error logging 
-        for name in [MAIN, SFTP, METADATA, DATA, FUSE, PARAMIKO]:
+        for name in [MAIN, DAEMON, SFTP, METADATA, DATA, FUSE, PARAMIKO]:
             logger = logging.getLogger(name)
-            errorHandler = logging.FileHandler(os.path.join(self.logDir, 'error.log'), mode='w')
+            errorHandler = logging.FileHandler(os.path.join(self.logDir, self.prefix + 'error.log'), mode='w')
             errorHandler.setFormatter(self.formatter) 
             errorHandler.setLevel(logging.ERROR)
             logger.addHandler(errorHandler)
@@ -42,7 +44,7 @@ class Log:
                 logger.setLevel(logging.ERROR)   
 
         # metrics logging
-        metricsHandler = logging.FileHandler(os.path.join(self.logDir, 'metrics.log'), mode='w')
+        metricsHandler = logging.FileHandler(os.path.join(self.logDir, self.prefix + 'metrics.log'), mode='w')
         metricsHandler.setFormatter(self.formatter)             
         logger = logging.getLogger(METRICS)
         logger.addHandler(metricsHandler)
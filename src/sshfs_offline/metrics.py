@@ -13,31 +13,61 @@ class Metrics:
        self.counts: dict[str,int] = dict()
        self.prevCounts: dict[str, int] = dict()
        self.stopped = False
+       self.throughputs: dict[str, list] = dict() # name -> [bytes, seconds] since the last log
+       self.gauges: dict[str, float] = dict() # name -> current value
+       self.prevGauges: dict[str, float] = dict()
+       self.lock = threading.Lock()
 
     def start(self):
         threading.Thread(target=self.captureLoop).start()
         
-    def incr(self, name: str): 
-        if name in self.counts:
-            self.counts[name] += 1
-        else:
-            self.counts[name] = 1                   
+    def incr(self, name: str, amount: int=1):
+        with self.lock:
+            if name in self.counts:
+                self.counts[name] += amount
+            else:
+                self.counts[name] = amount
+
+    def throughput(self, name: str, nbytes: int, seconds: float):
+        with self.lock:
+            total = self.throughputs.setdefault(name, [0, 0.0])
+            total[0] += nbytes
+            total[1] += seconds
+
+    def gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
 
     def _logCounts(self):
         lines: list[str] = []
         diff = 0
-        keys = list(self.counts.keys())
+        with self.lock:
+            counts = copy.deepcopy(self.counts)
+            throughputs = self.throughputs
+            self.throughputs = dict()
+            gauges = dict(self.gauges)
+        keys = list(counts.keys())
         keys.sort()
         for key in keys:
-            if key in self.prevCounts: 
-                diff = self.counts[key] - self.prevCounts[key]
+            if key in self.prevCounts:
+                diff = counts[key] - self.prevCounts[key]
             else:
-                diff = self.counts[key]
+                diff = counts[key]
             if diff > 0:
                 lines.append('\n   {}: {}'.format(key.ljust(16), diff))
-        
-        self.prevCounts = copy.deepcopy(self.counts)
-        
+
+        self.prevCounts = counts
+
+        for name in sorted(throughputs.keys()):
+            nbytes, seconds = throughputs[name]
+            if seconds > 0:
+                lines.append('\n   {}: {:.1f}'.format((name + '_MBps').ljust(16), nbytes / seconds / 1000000))
+
+        for name in sorted(gauges.keys()):
+            if gauges[name] != self.prevGauges.get(name):
+                lines.append('\n   {}: {:.1f}'.format(name.ljust(16), gauges[name]))
+        self.prevGauges = gauges
+
         if len(lines) > 0:
             self.log.info(''.join(lines))
 
@@ -75,12 +75,14 @@ class SftpOffline:
         raise FuseOSError(errno.ENETDOWN)         
 
 class SFTPManager:
-    def __init__(self, host, user, remotedir, port):
+    def __init__(self, host, user, remotedir, port, blockSize: int=BLOCK_SIZE):
         self.log = getLogger(log.SFTP)
+        self.blockSize = blockSize
         self.host = host
         self.user = user 
         self.password = None      
         self.remotedir = remotedir
+        self.home: str = None # login directory on the remote host
         self.port = port 
         self.local = threading.local()
         self.connections: dict[str, Connection] = dict() 
@@ -89,9 +91,13 @@ class SFTPManager:
         self.keepaliveStopped = False  
 
     def isConnected(self):
-        return not isinstance(self.sftp(), SftpOffline) and not self.offline
+        return not isinstance(self._sftp(), SftpOffline) and not self.offline
 
     def sftp(self) -> paramiko.SFTPClient | SftpOffline:                    
+        self.markRemote()
+        return self._sftp()
+
+    def _sftp(self) -> paramiko.SFTPClient | SftpOffline:
         threadId = threading.get_native_id()
         if self.offline:
             if threadId in self.connections:
@@ -113,11 +119,13 @@ class SFTPManager:
                 self.log.debug('sftp: Cannot connect to host '+self.host)
                 print('Cannot connect to host ' + self.host + '.   Only cached data will be available.')
                 metrics.counts.incr('sftp_connect_err') 
+                self.offline = True # until the keepalive thread reconnects
                 return SftpOffline()
             except OSError as e:
                 self.log.debug('sftp: %s', e)
                 print('{}.   Only cached data will be available.'.format(e))
                 metrics.counts.incr('sftp_network_err') 
+                self.offline = True # until the keepalive thread reconnects
                 return SftpOffline()
             except paramiko.ssh_exception.AuthenticationException:
                 self.password = getpass.getpass("Enter password: ")
@@ -132,7 +140,9 @@ class SFTPManager:
             metrics.counts.incr('sftp_connected') 
             sshClient.get_transport().default_window_size = WINDOW_SIZE
             self.connections[threadId] = Connection(sshClient, sshClient.open_sftp())
-            self.connections[threadId].sftpClient.SFTP_FILE_OBJECT_BLOCK_SIZE = BLOCK_SIZE
+            self.connections[threadId].sftpClient.SFTP_FILE_OBJECT_BLOCK_SIZE = self.blockSize
+            if self.home == None:
+                self.home = self.connections[threadId].sftpClient.normalize('.')
             try:
                 self.connections[threadId].sftpClient.chdir(self.remotedir)
                 metrics.counts.incr('sftp_chdir') 
@@ -145,9 +155,32 @@ class SFTPManager:
                            
         return self.connections[threadId].sftpClient    
     
-    def sftpClose(self):
+    def markRemote(self):
+        '''
+        Mark that the calling thread's operation went to the remote host (or waited for another thread that did).
+        '''
+        self.local.remote = True
+
+    def takeRemote(self) -> bool:
+        '''
+        Whether the calling thread went to the remote host since the previous call.
+        '''
+        remote = getattr(self.local, 'remote', False)
+        self.local.remote = False
+        return remote
+
+    def sshClient(self) -> paramiko.SSHClient | None:
+        '''
+        SSH client of the calling thread's connection, or None when offline.
+        '''
+        if isinstance(self.sftp(), SftpOffline):
+            return None
+        return self.connections[threading.get_native_id()].sshClient
+
+    def sftpClose(self, threadId: int=None):
         metrics.counts.incr('sftp_close')
-        threadId = threading.get_native_id()
+        if threadId == None:
+            threadId = threading.get_native_id()
         val = self.connections.pop(threadId)
         val.sftpClient.close()
         val.sshClient.close() 
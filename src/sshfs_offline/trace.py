@@ -0,0 +1,558 @@
+import argparse
+import errno
+import json
+import os
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Iterator
+
+from sshfs_offline import sftp
+
+MAGIC = b'SSHFSTR1'
+HEADER = struct.Struct('<I') # length of the JSON mount options that follow the magic
+PATH = struct.Struct('<BH') # kind, length of the utf-8 path that follows
+OP = struct.Struct('<BBBHIIIdfqq') # kind, op, flags, errno, thread, path id, path2 id, start, latency, offset, size
+PATH_KIND = 0
+OP_KIND = 1
+NO_PATH = 0xffffffff
+REMOTE = 0x1 # the operation went to the remote host
+TYPE_MASK = 0x6 # file type of the path, when getattr found it
+TYPE_FILE = 0x2
+TYPE_DIR = 0x4
+TYPE_LINK = 0x6
+
+OPS = ('getattr', 'readdir', 'readlink', 'open', 'read', 'write', 'create', 'mkdir', 'rmdir', 'unlink', 'rename',
+       'symlink', 'truncate', 'utimens', 'chmod', 'chown', 'statfs')
+
+class Op:
+    '''
+    A recorded operation.  The arguments of the operation are in path, path2, offset and size: the mode of create,
+    mkdir and chmod, and the length of truncate, are in size, and the uid and gid of chown are in offset and size.
+    '''
+    def __init__(self, op: str, path: str, path2: str, offset: int, size: int):
+        self.op = op
+        self.path = path
+        self.path2 = path2
+        self.offset = offset
+        self.size = size
+        self.thread = 0
+        self.start = 0.0
+        self.latency = 0.0
+        self.remote = False
+        self.errno = 0
+        self.fileType = 0 # TYPE_FILE, TYPE_DIR, TYPE_LINK or 0 when unknown
+
+    @staticmethod
+    def fromArgs(op: str, args: tuple) -> 'Op':
+        if op == 'read':
+            return Op(op, args[0], None, args[2], args[1])
+        elif op == 'write':
+            return Op(op, args[0], None, args[2], len(args[1]))
+        elif op in ('rename', 'symlink'):
+            return Op(op, args[0], args[1], 0, 0)
+        elif op in ('create', 'mkdir', 'chmod', 'truncate'):
+            return Op(op, args[0], None, 0, args[1])
+        elif op == 'chown':
+            return Op(op, args[0], None, args[1], args[2])
+        return Op(op, args[0], None, 0, 0)
+
+class Recorder:
+    '''
+    Record the FUSE operations of a mount to a compact binary trace file.  Each path is written once, and the
+    operations refer to it by number.  The trace is flushed every FLUSH_INTERVAL seconds, so a mount that is killed
+    loses at most the last interval.
+    '''
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, tracePath: str, options: dict):
+        self.lock = threading.Lock()
+        self.file = open(tracePath, 'wb')
+        self.paths: dict[str, int] = dict()
+        self.startTime = time.time()
+        options = dict(options, start=self.startTime)
+        buf = json.dumps(options).encode()
+        self.file.write(MAGIC + HEADER.pack(len(buf)) + buf)
+        self.file.flush()
+        threading.Thread(target=self.flushThread, daemon=True).start()
+
+    def record(self, op: str, args: tuple, call):
+        '''
+        Call the operation and record it.
+        '''
+        if op not in OPS:
+            return call(op, *args)
+        sftp.manager.takeRemote()
+        start = time.time()
+        startCounter = time.perf_counter()
+        e = 0
+        result = None
+        try:
+            result = call(op, *args)
+            if op == 'readdir':
+                result = list(result) # the listing is read in the operation
+            return result
+        except OSError as ex:
+            e = ex.errno or errno.EIO
+            raise ex
+        except Exception as ex:
+            e = errno.EIO
+            raise ex
+        finally:
+            latency = time.perf_counter() - startCounter
+            flags = REMOTE if sftp.manager.takeRemote() else 0
+            if op == 'getattr' and e == 0:
+                flags |= _fileType(result['st_mode'])
+            self._write(Op.fromArgs(op, args), start, latency, flags, e)
+
+    def _write(self, op: Op, start: float, latency: float, flags: int, e: int):
+        with self.lock:
+            if self.file == None:
+                return
+            pathId = self._pathId(op.path)
+            path2Id = self._pathId(op.path2) if op.path2 != None else NO_PATH
+            self.file.write(OP.pack(OP_KIND, OPS.index(op.op), flags, e,
+                                    threading.get_native_id(), pathId, path2Id, start - self.startTime, latency,
+                                    op.offset, op.size))
+
+    def _pathId(self, path: str) -> int:
+        pathId = self.paths.get(path)
+        if pathId == None:
+            pathId = len(self.paths)
+            self.paths[path] = pathId
+            buf = path.encode(errors='surrogateescape')
+            self.file.write(PATH.pack(PATH_KIND, len(buf)) + buf)
+        return pathId
+
+    def flushThread(self):
+        while True:
+            time.sleep(Recorder.FLUSH_INTERVAL)
+            with self.lock:
+                if self.file == None:
+                    break
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file != None:
+                self.file.close()
+                self.file = None
+
+def readTrace(tracePath: str) -> tuple[dict, Iterator[Op]]:
+    '''
+    The mount options and the operations of a trace file.  A trace of a mount that was killed can end with a partial
+    record, which is skipped with a warning.
+    '''
+    file = open(tracePath, 'rb')
+    if file.read(len(MAGIC)) != MAGIC:
+        file.close()
+        raise ValueError('{} is not a trace file'.format(tracePath))
+    options = json.loads(file.read(HEADER.unpack(file.read(HEADER.size))[0]))
+
+    def ops() -> Iterator[Op]:
+        paths: list[str] = []
+        with file:
+            try:
+                while True:
+                    kind = file.read(1)
+                    if len(kind) == 0:
+                        break
+                    if kind[0] == PATH_KIND:
+                        n = PATH.unpack(kind + _read(file, PATH.size - 1))[1]
+                        paths.append(_read(file, n).decode(errors='surrogateescape'))
+                    else:
+                        (kind, opIndex, flags, e, thread, pathId, path2Id, start, latency,
+                         offset, size) = OP.unpack(kind + _read(file, OP.size - 1))
+                        op = Op(OPS[opIndex], paths[pathId], paths[path2Id] if path2Id != NO_PATH else None, offset, size)
+                        op.thread, op.start, op.latency, op.remote, op.errno = thread, start, latency, flags & REMOTE != 0, e
+                        op.fileType = flags & TYPE_MASK
+                        yield op
+            except EOFError:
+                print('warning: {} ends with a partial record'.format(tracePath), file=sys.stderr)
+
+    return options, ops()
+
+def _fileType(mode: int) -> int:
+    if stat.S_ISDIR(mode):
+        return TYPE_DIR
+    if stat.S_ISLNK(mode):
+        return TYPE_LINK
+    return TYPE_FILE
+
+def _read(file, n: int) -> bytes:
+    buf = file.read(n)
+    if len(buf) < n:
+        raise EOFError()
+    return buf
+
+class _LocalFile:
+    def __init__(self, path: str, mode: str):
+        self.file = open(path, {'r': 'rb', 'rb': 'rb', 'r+': 'r+b', 'w': 'wb'}[mode])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def seek(self, offset: int, whence: int=0):
+        self.file.seek(offset, whence)
+
+    def read(self, size: int) -> bytes:
+        return self.file.read(size)
+
+    def readv(self, chunks: list[tuple[int, int]]) -> Iterator[bytes]:
+        for offset, size in chunks:
+            yield os.pread(self.file.fileno(), size, offset)
+
+    def write(self, buf: bytes):
+        self.file.write(buf)
+
+    def flush(self):
+        self.file.flush()
+
+    def stat(self) -> os.stat_result:
+        self.file.flush()
+        return os.fstat(self.file.fileno())
+
+    def chmod(self, mode: int):
+        os.fchmod(self.file.fileno(), mode)
+
+    def close(self):
+        self.file.close()
+
+class _LocalAttributes:
+    def __init__(self, st: os.stat_result, filename: str):
+        for key in ('st_atime', 'st_gid', 'st_mode', 'st_mtime', 'st_size', 'st_uid'):
+            setattr(self, key, getattr(st, key))
+        self.filename = filename
+
+class SftpLocal:
+    '''
+    SFTP stand-in that serves a local directory as the remote directory, for replaying traces without a host.
+    '''
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, path)
+
+    def close(self) -> None:
+        pass
+    def listdir(self, path: str = ".") -> list[str]:
+        return os.listdir(self._path(path))
+    def listdir_attr(self, path: str = ".") -> list[_LocalAttributes]:
+        return [_LocalAttributes(os.lstat(entry.path), entry.name) for entry in os.scandir(self._path(path))]
+    def open(self, filename: str, mode: str = "r", bufsize: int = -1) -> _LocalFile:
+        return _LocalFile(self._path(filename), mode)
+    def remove(self, path: str) -> None:
+        os.unlink(self._path(path))
+    unlink = remove
+    def rename(self, oldpath: str, newpath: str) -> None:
+        os.rename(self._path(oldpath), self._path(newpath))
+    def mkdir(self, path: str, mode: int = 511) -> None:
+        os.mkdir(self._path(path), mode)
+    def rmdir(self, path: str) -> None:
+        os.rmdir(self._path(path))
+    def stat(self, path: str) -> os.stat_result:
+        return os.stat(self._path(path))
+    def lstat(self, path: str) -> os.stat_result:
+        return os.lstat(self._path(path))
+    def symlink(self, source: str, dest: str) -> None:
+        os.symlink(source, self._path(dest))
+    def chmod(self, path: str, mode: int) -> None:
+        os.chmod(self._path(path), mode)
+    def chown(self, path: str, uid: int, gid: int) -> None:
+        pass # the replay does not run as the owner
+    def utime(self, path: str, times: tuple[float, float] | None) -> None:
+        os.utime(self._path(path), times)
+    def truncate(self, path: str, size: int) -> None:
+        os.truncate(self._path(path), size)
+    def readlink(self, path: str) -> str | None:
+        return os.readlink(self._path(path))
+    def normalize(self, path: str) -> str:
+        return os.path.normpath(os.path.join('/', path))
+    def getcwd(self) -> str | None:
+        return None
+
+class LocalManager(sftp.SFTPManager):
+    '''
+    SFTP manager of a replay.  It is always connected, and has no SSH client, so snapshots use SFTP listings.
+    '''
+    def __init__(self, host: str, root: str, blockSize: int):
+        super().__init__(host, None, '/', None, blockSize)
+        self.root = root
+
+    def isConnected(self):
+        return True
+
+    def sftp(self) -> SftpLocal:
+        self.markRemote()
+        return SftpLocal(self.root)
+
+    def sshClient(self) -> None:
+        return None
+
+    def sftpClose(self, threadId: int=None):
+        pass
+
+class _FileInfo:
+    def __init__(self):
+        self.keep_cache = 0
+
+class Replay:
+    '''
+    Replay a trace by calling the operations of Main directly, without the kernel, against a local directory that
+    stands in for the remote directory and a fresh or snapshotted cache.  Each recorded thread is replayed by its own
+    thread in recorded order, or all operations are replayed in recorded order by one thread when serial.
+    '''
+    def __init__(self, tracePath: str, remoteDir: str=None, cacheDir: str=None, speed: str='max', serial: bool=False):
+        self.tracePath = tracePath
+        self.remoteDir = remoteDir
+        self.cacheDir = cacheDir
+        self.speed = speed
+        self.serial = serial
+        self.results: list[Op] = []
+        self.lock = threading.Lock()
+        self.workDir: str = None
+
+    def run(self) -> dict:
+        from sshfs_offline import cli
+        from sshfs_offline.cache import data
+        from sshfs_offline.cache import metadata
+
+        options, ops = readTrace(self.tracePath)
+        ops = list(ops)
+        workDir = tempfile.mkdtemp(prefix='sshfs-offline-replay-')
+        self.workDir = workDir
+        try:
+            # the cache of the replay is a fresh, or a copy of a snapshotted, ~/.sshfs-offline directory
+            cacheDir = os.path.join(workDir, 'cache')
+            if self.cacheDir != None:
+                shutil.copytree(self.cacheDir, cacheDir, symlinks=True)
+            metadata.Metadata.METADATA_DIR = os.path.join(cacheDir, 'metadata')
+            data.Data.DATA_DIR = os.path.join(cacheDir, 'data')
+
+            remoteDir = self.remoteDir
+            if remoteDir == None:
+                remoteDir = os.path.join(workDir, 'remote')
+                synthesize(ops, remoteDir)
+
+            # the cache is keyed by the recorded host and remote directory, so a snapshot of it can be used
+            args = argparse.Namespace(**options)
+            args.snapshot = None
+            args.debug = False
+            main = cli.Main(args, LocalManager(args.host, remoteDir, args.blocksize))
+
+            startTime = time.time()
+            if self.serial:
+                self._replay(main, ops, startTime)
+            else:
+                threadOps: dict[int, list[Op]] = dict()
+                for op in ops:
+                    threadOps.setdefault(op.thread, []).append(op)
+                threads = [threading.Thread(target=self._replay, args=(main, o, startTime)) for o in threadOps.values()]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            wallTime = time.time() - startTime
+        except Exception as e:
+            self.close()
+            raise e
+
+        result = summary(self.results)
+        result['trace'] = self.tracePath
+        result['speed'] = self.speed
+        result['serial'] = self.serial
+        result['wall_s'] = round(wallTime, 3)
+        return result
+
+    def close(self):
+        '''
+        Remove the cache and the stand-in remote directory of the replay.  The prefetch thread may still use them, so
+        this is done when the replay process exits.
+        '''
+        if self.workDir != None:
+            shutil.rmtree(self.workDir, ignore_errors=True)
+            self.workDir = None
+
+    def _replay(self, main, ops: list[Op], startTime: float):
+        for op in ops:
+            if self.speed == 'original':
+                delay = startTime + op.start - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            result = Op(op.op, op.path, op.path2, op.offset, op.size)
+            sftp.manager.takeRemote()
+            startCounter = time.perf_counter()
+            try:
+                self._call(main, op)
+            except OSError as e:
+                result.errno = e.errno or errno.EIO
+            except Exception as e:
+                result.errno = errno.EIO # an error of the filesystem, not of the replay
+            result.latency = time.perf_counter() - startCounter
+            result.remote = sftp.manager.takeRemote()
+            with self.lock:
+                self.results.append(result)
+
+    def _call(self, main, op: Op):
+        if op.op == 'read':
+            main.read(op.path, op.size, op.offset, None)
+        elif op.op == 'write':
+            main.write(op.path, bytes(op.size), op.offset, None)
+        elif op.op == 'readdir':
+            list(main.readdir(op.path, None))
+        elif op.op == 'open':
+            main.open(op.path, _FileInfo())
+        elif op.op == 'create':
+            main.create(op.path, op.size, _FileInfo())
+        elif op.op in ('mkdir', 'chmod', 'truncate'):
+            getattr(main, op.op)(op.path, op.size)
+        elif op.op == 'chown':
+            main.chown(op.path, op.offset, op.size)
+        elif op.op in ('rename', 'symlink'):
+            getattr(main, op.op)(op.path, op.path2)
+        elif op.op == 'utimens':
+            main.utimens(op.path, None)
+        else:
+            getattr(main, op.op)(op.path)
+
+def synthesize(ops: list[Op], remoteDir: str):
+    '''
+    Create a stand-in remote directory from the trace.  Only the paths that existed before the trace are created,
+    those whose first use found them, with the file type that was recorded or implied by the operations, and sparse
+    files large enough for the recorded reads.  The paths that the trace creates are left to the replay.
+    '''
+    types: dict[str, int] = dict() # path -> file type, of the paths to create
+    sizes: dict[str, int] = dict()
+    used: set[str] = set()
+    renames: list[tuple[str, str]] = []
+    for op in ops:
+        # a path that was renamed by the trace existed under its old name
+        path = op.path
+        for old, new in reversed(renames):
+            if path == new or path.startswith(new + '/'):
+                path = old + path[len(new):]
+                break # old is the name before the trace
+        if path not in used:
+            used.add(path)
+            if op.op in ('create', 'mkdir', 'symlink'):
+                existed = op.errno == errno.EEXIST
+            else:
+                existed = op.errno == 0
+            if existed and path != '/':
+                types[path] = 0
+        if path in types:
+            types[path] = op.fileType or _IMPLIED_TYPES.get(op.op, 0) or types[path]
+            if op.op == 'read':
+                sizes[path] = max(sizes.get(path, 0), op.offset + op.size)
+        if op.op == 'rename' and op.errno == 0:
+            renames.append((path, op.path2))
+
+    for path in list(types.keys()):
+        parent = os.path.dirname(path)
+        while parent not in ('/', ''):
+            types[parent] = TYPE_DIR
+            parent = os.path.dirname(parent)
+
+    os.makedirs(remoteDir)
+    for path in sorted(types.keys()):
+        localPath = os.path.join(remoteDir, path.lstrip('/'))
+        if types[path] == TYPE_DIR:
+            os.makedirs(localPath, exist_ok=True)
+        elif types[path] == TYPE_LINK:
+            os.symlink('synthesized', localPath) # the target is not recorded
+        else:
+            with open(localPath, 'wb') as file:
+                file.truncate(sizes.get(path, 0))
+
+_IMPLIED_TYPES = {'readdir': TYPE_DIR, 'rmdir': TYPE_DIR, 'mkdir': TYPE_DIR, 'readlink': TYPE_LINK, 'symlink': TYPE_LINK,
+                  'read': TYPE_FILE, 'write': TYPE_FILE, 'open': TYPE_FILE, 'create': TYPE_FILE, 'truncate': TYPE_FILE}
+
+def summary(ops: list[Op]) -> dict:
+    '''
+    Latency distribution of each operation, in milliseconds.
+    '''
+    byOp: dict[str, list[Op]] = dict()
+    for op in ops:
+        byOp.setdefault(op.op, []).append(op)
+    result = {'ops': {name: _distribution(byOp[name]) for name in sorted(byOp.keys())}}
+    result['total'] = _distribution(ops)
+    return result
+
+def _distribution(ops: list[Op]) -> dict:
+    latencies = sorted(op.latency * 1000 for op in ops)
+    percentile = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if len(latencies) > 0 else 0
+    return {
+        'count': len(ops),
+        'errors': sum(1 for op in ops if op.errno != 0),
+        'remote': sum(1 for op in ops if op.remote),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if len(latencies) > 0 else 0,
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(latencies[-1], 3) if len(latencies) > 0 else 0,
+    }
+
+def compare(base: dict, new: dict):
+    '''
+    Print the latency distributions of two replays, or of two recorded traces, side by side.
+    '''
+    print('{:<10}{:>8}{:>8}  {:>23}  {:>23}  {:>23}'.format('op', 'count', 'remote', 'p50 ms', 'p90 ms', 'p99 ms'))
+    names = sorted(set(base['ops'].keys()) | set(new['ops'].keys()))
+    empty = _distribution([])
+    for name in names + ['total']:
+        b = base['ops'].get(name, empty) if name != 'total' else base['total']
+        n = new['ops'].get(name, empty) if name != 'total' else new['total']
+        line = '{:<10}{:>8}{:>8}'.format(name, n['count'], n['remote'])
+        for key in ('p50_ms', 'p90_ms', 'p99_ms'):
+            change = '{:+.0%}'.format(n[key] / b[key] - 1) if b[key] > 0 else ''
+            line += '  {:>8.3f} {:>8.3f} {:>5}'.format(b[key], n[key], change)
+        print(line)
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog='sshfs-offline trace')
+    parser.description = 'Summarize, replay and compare traces recorded with sshfs-offline --trace.'
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    statsParser = subparsers.add_parser('stats', help='latency distributions of the recorded operations (JSON)')
+    statsParser.add_argument('trace', help='trace file')
+    replayParser = subparsers.add_parser('replay', help='replay a trace without the kernel and report latency distributions (JSON)')
+    replayParser.add_argument('trace', help='trace file')
+    replayParser.add_argument('--remote', help='local directory that stands in for the remote directory (default: synthesized from the trace)')
+    replayParser.add_argument('--cache', help='snapshot of a ~/.sshfs-offline directory to start the replay with (default: empty cache)')
+    replayParser.add_argument('--speed', choices=['original', 'max'], default='max', help='replay at the recorded pace or as fast as possible (default=max)')
+    replayParser.add_argument('--serial', action='store_true', help='replay all operations in recorded order on one thread')
+    compareParser = subparsers.add_parser('compare', help='compare the latency distributions of two stats or replay reports')
+    compareParser.add_argument('base', help='JSON report')
+    compareParser.add_argument('new', help='JSON report')
+    args = parser.parse_args(argv)
+
+    if args.command == 'stats':
+        options, ops = readTrace(args.trace)
+        result = summary(list(ops))
+        result['trace'] = args.trace
+        print(json.dumps(result, indent=4))
+    elif args.command == 'replay':
+        replay = Replay(args.trace, args.remote, args.cache, args.speed, args.serial)
+        status = 0
+        try:
+            print(json.dumps(replay.run(), indent=4), flush=True)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        replay.close()
+        sys.stderr.flush()
+        os._exit(status) # the prefetch thread does not stop
+    elif args.command == 'compare':
+        with open(args.base) as file:
+            base = json.load(file)
+        with open(args.new) as file:
+            new = json.load(file)
+        compare(base, new)
@@ -0,0 +1,34 @@
+import argparse
+
+import pytest
+
+@pytest.fixture
+def remote(tmp_path) -> str:
+    '''
+    Local directory that stands in for the remote directory of the mount.
+    '''
+    path = tmp_path / 'remote'
+    path.mkdir()
+    return str(path)
+
+@pytest.fixture
+def args(tmp_path) -> argparse.Namespace:
+    return argparse.Namespace(debug=False, host='host', user='user', port=22, remotedir='/base', snapshot=None,
+                              cachetimeout=300, blocksize=4096, stripes=1, stripeminsize=1 << 40, ramcache=0, trace=None)
+
+@pytest.fixture
+def main(tmp_path, monkeypatch, remote, args):
+    '''
+    Main over the stand-in remote directory, with its cache in tmp_path and without background prefetching.
+    '''
+    try:
+        from sshfs_offline import cli
+        from sshfs_offline import trace
+        from sshfs_offline.cache import data
+        from sshfs_offline.cache import metadata
+    except (ImportError, OSError):
+        pytest.skip('needs fusepy, libfuse and paramiko')
+    monkeypatch.setattr(metadata.Metadata, 'METADATA_DIR', str(tmp_path / 'cache' / 'metadata'))
+    monkeypatch.setattr(data.Data, 'DATA_DIR', str(tmp_path / 'cache' / 'data'))
+    monkeypatch.setattr(data.Data, 'fileReaderThread', lambda self: None)
+    return cli.Main(args, trace.LocalManager(args.host, remote, args.blocksize))
@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+import pytest
+
+try:
+    from sshfs_offline import metrics
+    from sshfs_offline import trace
+    from sshfs_offline.cache import data
+except (ImportError, OSError):
+    pytest.skip('needs fusepy, libfuse and paramiko', allow_module_level=True)
+
+@pytest.fixture
+def fetches(monkeypatch) -> list[list[tuple[int, int]]]:
+    '''
+    The ranges of each remote read, which are slow enough for concurrent reads to overlap them.
+    '''
+    fetches: list[list[tuple[int, int]]] = []
+    readv = trace._LocalFile.readv
+    def slowReadv(self, chunks):
+        fetches.append(list(chunks))
+        time.sleep(0.2)
+        return readv(self, chunks)
+    monkeypatch.setattr(trace._LocalFile, 'readv', slowReadv)
+    return fetches
+
+def remoteFile(remote: str, name: str, size: int) -> bytes:
+    buf = os.urandom(size)
+    with open(os.path.join(remote, name), 'wb') as file:
+        file.write(buf)
+    return buf
+
+def test_concurrent_reads_fetch_once(main, remote, fetches):
+    buf = remoteFile(remote, 'f', 100000)
+    barrier = threading.Barrier(8)
+    results: dict[int, bytes] = dict()
+    def read(i: int):
+        barrier.wait()
+        results[i] = main.read('/f', 4096, i * 4096, None)
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fetches == [[(0, 100000)]] # small files are fetched whole
+    assert all(results[i] == buf[i*4096:(i+1)*4096] for i in range(8))
+    assert metrics.counts.counts['read_fetch_avoided'] == 7
+    assert main.read('/f', 100000, 0, None) == buf
+    assert len(fetches) == 1
+
+def test_overlapping_read_fetches_the_rest(main, remote, fetches, monkeypatch):
+    monkeypatch.setattr(data.Data, 'WHOLE_FILE_SIZE', 0)
+    buf = remoteFile(remote, 'f', 100000)
+    first = threading.Thread(target=main.read, args=('/f', 8192, 0, None))
+    first.start()
+    while len(fetches) == 0:
+        time.sleep(0.01)
+    assert main.read('/f', 8192, 4096, None) == buf[4096:12288]
+    first.join()
+    assert fetches == [[(0, 8192)], [(8192, 4096)]]
+    assert metrics.counts.counts['read_fetch_avoided'] == 1
+    assert main.read('/f', 12288, 0, None) == buf[:12288]
+    assert len(fetches) == 2
+
+def test_write_through(main, remote, fetches):
+    main.create('/n', 0o644, trace._FileInfo())
+    buf = os.urandom(10000)
+    for offset in range(0, len(buf), 4096):
+        main.write('/n', buf[offset:offset+4096], offset, None)
+    assert main.read('/n', 10000, 0, None) == buf
+    assert fetches == []
+
+def test_write_to_cached_file(main, remote, fetches):
+    buf = bytearray(remoteFile(remote, 'f', 10000))
+    main.read('/f', 10000, 0, None)
+    main.write('/f', b'xyz', 9999, None)
+    buf[9999:] = b'xyz'
+    assert main.read('/f', 20000, 0, None) == buf
+    assert len(fetches) == 1
+
+def test_truncate(main, remote, fetches):
+    buf = remoteFile(remote, 'f', 10000)
+    main.read('/f', 10000, 0, None)
+    main.truncate('/f', 3000)
+    assert main.read('/f', 10000, 0, None) == buf[:3000]
+    main.truncate('/f', 6000)
+    assert main.read('/f', 10000, 0, None) == buf[:3000] + bytes(3000)
+    assert len(fetches) == 1
+
+def test_concurrent_writes(main, remote, monkeypatch):
+    main.create('/n', 0o644, trace._FileInfo())
+    written = threading.Event()
+    write = data.Data.write
+    def pausedWrite(self, path, buf, offset, fileSize):
+        if buf.startswith(b'a'):
+            written.wait(0.5) # between the remote write and the cache write, let the other write go first
+        write(self, path, buf, offset, fileSize)
+        if buf.startswith(b'b'):
+            written.set()
+    monkeypatch.setattr(data.Data, 'write', pausedWrite)
+    first = threading.Thread(target=main.write, args=('/n', b'a' * 100, 0, None))
+    first.start()
+    time.sleep(0.1)
+    main.write('/n', b'b' * 100, 0, None)
+    first.join()
+    with open(os.path.join(remote, 'n'), 'rb') as file:
+        assert main.read('/n', 100, 0, None) == file.read()
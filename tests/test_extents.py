@@ -0,0 +1,57 @@
+from sshfs_offline.cache.extents import Extents
+
+def extents(*ranges: tuple[int, int]) -> Extents:
+    e = Extents()
+    for start, end in ranges:
+        e.add(start, end)
+    return e
+
+def test_add_merges_overlapping_and_adjacent():
+    e = extents((0, 10), (20, 30), (10, 15), (25, 40))
+    assert list(e) == [(0, 15), (20, 40)]
+    e.add(15, 20)
+    assert list(e) == [(0, 40)]
+
+def test_add_spanning_several_extents():
+    e = extents((10, 20), (30, 40), (50, 60))
+    e.add(5, 55)
+    assert list(e) == [(5, 60)]
+
+def test_add_empty_range():
+    e = extents((10, 20))
+    e.add(30, 30)
+    assert list(e) == [(10, 20)]
+
+def test_missing():
+    e = extents((10, 20), (30, 40))
+    assert e.missing(0, 50) == [(0, 10), (20, 30), (40, 50)]
+    assert e.missing(12, 35) == [(20, 30)]
+    assert e.missing(20, 30) == [(20, 30)]
+    assert e.missing(10, 20) == []
+    assert e.contains(30, 40)
+    assert not e.contains(15, 25)
+    assert Extents().missing(0, 5) == [(0, 5)]
+
+def test_truncate():
+    e = extents((0, 10), (20, 30), (40, 50))
+    e.truncate(25)
+    assert list(e) == [(0, 10), (20, 25)]
+    e.truncate(20)
+    assert list(e) == [(0, 10)]
+    e.truncate(0)
+    assert list(e) == []
+
+def test_bytes_round_trip():
+    e = extents((0, 10), (1 << 40, (1 << 40) + 5))
+    assert list(Extents.fromBytes(e.toBytes())) == list(e)
+
+def test_from_blockmap_partial_last_block():
+    blockMap = bytes([1, 1, 0, 1])
+    assert list(Extents.fromBlockMap(blockMap, 100)) == [(0, 200), (300, 400)]
+    assert list(Extents.fromBlockMap(blockMap, 100, 350)) == [(0, 200), (300, 350)]
+    assert list(Extents.fromBlockMap(blockMap, 100, 250)) == [(0, 200)]
+
+def test_cached_bytes():
+    e = extents((0, 10), (20, 30))
+    assert e.cachedBytes(100) == 20
+    assert e.cachedBytes(25) == 15
@@ -0,0 +1,60 @@
+from sshfs_offline.cache.memory import Memory
+
+def test_get_put():
+    m = Memory(100)
+    assert m.get('/a', 0) == None
+    m.put('/a', 0, b'x' * 10, m.generation('/a'))
+    assert m.get('/a', 0) == b'x' * 10
+    assert m.get('/a', 1) == None
+    assert m.size() == 10
+
+def test_scan_evicts_blocks_read_once():
+    m = Memory(100)
+    for blockNum in range(2):
+        m.put('/hot', blockNum, b'h' * 20, m.generation('/hot'))
+        m.get('/hot', blockNum) # promoted to the protected segment
+    for blockNum in range(10):
+        m.put('/scan', blockNum, b's' * 20, m.generation('/scan'))
+    assert m.get('/hot', 0) != None and m.get('/hot', 1) != None
+    assert m.get('/scan', 0) == None
+    assert m.get('/scan', 9) != None
+    assert m.size() <= 100
+
+def test_protected_segment_is_bounded():
+    m = Memory(100)
+    for blockNum in range(5):
+        m.put('/a', blockNum, b'a' * 20, m.generation('/a'))
+        m.get('/a', blockNum)
+    assert m.protectedSize <= 100 * Memory.PROTECTED
+    assert m.size() == 100
+
+def test_block_larger_than_memory():
+    m = Memory(10)
+    m.put('/a', 0, b'a' * 20, m.generation('/a'))
+    assert m.get('/a', 0) == None
+    assert m.size() == 0
+
+def test_invalidate():
+    m = Memory(100)
+    m.put('/a', 0, b'a', m.generation('/a'))
+    m.put('/b', 0, b'b', m.generation('/b'))
+    m.invalidate('/a')
+    assert m.get('/a', 0) == None
+    assert m.get('/b', 0) == b'b'
+    assert m.size() == 1
+
+def test_invalidate_tree():
+    m = Memory(100)
+    for path in ['/d', '/d/a', '/d/e/b', '/dd']:
+        m.put(path, 0, b'x', m.generation(path))
+    m.invalidate('/d', tree=True)
+    assert [m.get(path, 0) for path in ['/d', '/d/a', '/d/e/b', '/dd']] == [None, None, None, b'x']
+
+def test_put_after_invalidate_is_dropped():
+    m = Memory(100)
+    generation = m.generation('/a') # block read from the disk tier
+    m.invalidate('/a') # file changed before the block is added
+    m.put('/a', 0, b'old', generation)
+    assert m.get('/a', 0) == None
+    m.put('/a', 0, b'new', m.generation('/a'))
+    assert m.get('/a', 0) == b'new'
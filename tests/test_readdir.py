@@ -0,0 +1,91 @@
+import pytest
+
+try:
+    import fuse # fusepy raises OSError when libfuse is not installed
+    import paramiko
+except (ImportError, OSError):
+    pytest.skip('needs fusepy, libfuse and paramiko', allow_module_level=True)
+
+from sshfs_offline import metrics
+from sshfs_offline import sftp
+from sshfs_offline.cache import metadata
+
+class Connected:
+    offline = False
+    def isConnected(self):
+        return True
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch) -> metadata.Metadata:
+    monkeypatch.setattr(metadata.Metadata, 'METADATA_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, 'counts', metrics.Metrics(), raising=False)
+    monkeypatch.setattr(sftp, 'manager', Connected(), raising=False)
+    return metadata.Metadata('host', '/base', 300)
+
+def test_save(cache):
+    assert cache.readdir('/d') == None
+    assert cache.readdir_contains('/d', 'a') == None
+    cache.readdir_save('/d', ['c', 'a', 'b'])
+    assert list(cache.readdir('/d')) == ['a', 'b', 'c']
+    assert cache.readdir_contains('/d', 'b') == True
+    assert cache.readdir_contains('/d', 'z') == False
+
+def test_log_replay(cache):
+    cache.readdir_save('/d', ['a', 'c'])
+    cache.readdir_add('/d', 'b')
+    cache.readdir_remove('/d', 'c')
+    cache.readdir_add('/d', 'e')
+    cache.readdir_remove('/d', 'e')
+    cache.readdir_add('/d', 'c')
+    cache.readdir_add('/d', 'a')
+    assert list(cache.readdir('/d')) == ['a', 'b', 'c']
+    assert cache.readdir_contains('/d', 'b') == True
+    assert cache.readdir_contains('/d', 'e') == False
+    cache.readdir_remove('/d', 'a')
+    assert list(cache.readdir('/d')) == ['b', 'c']
+    assert cache.readdir_contains('/d', 'a') == False
+
+def test_log_without_listing(cache):
+    cache.readdir_add('/d', 'a')
+    assert cache.readdir('/d') == None
+
+def test_save_replaces_log(cache):
+    cache.readdir_save('/d', ['a'])
+    cache.readdir_add('/d', 'b')
+    cache.readdir_save('/d', ['a', 'c'])
+    assert list(cache.readdir('/d')) == ['a', 'c']
+    assert cache.readdir_contains('/d', 'b') == False
+
+def test_save_of_listing_older_than_change(cache):
+    cache.readdir_save('/d', ['a'])
+    sequence = cache.readdir_sequence() # listing started
+    cache.readdir_add('/d', 'b')
+    cache.readdir_save('/d', ['a'], sequence)
+    assert list(cache.readdir('/d')) == ['a', 'b']
+    cache.readdir_save('/d', ['a', 'b'], cache.readdir_sequence())
+    assert list(cache.readdir('/d')) == ['a', 'b']
+
+def test_long_log_drops_listing(cache, monkeypatch):
+    monkeypatch.setattr(metadata.Metadata, 'READDIR_LOG_MAX', 64)
+    cache.readdir_save('/d', ['a'])
+    for i in range(10):
+        cache.readdir_add('/d', 'name{}'.format(i))
+    assert cache.readdir('/d') == None # relisted on the next readdir
+
+def test_name_like_old_format(cache):
+    cache.readdir_save('/d', ['[]', 'a'])
+    assert list(cache.readdir('/d')) == ['[]', 'a']
+    assert cache.readdir_contains('/d', '[]') == True
+
+def test_old_format_is_relisted(cache):
+    readdirPath = cache._metadataPath('/d', metadata.Metadata.READDIR)
+    with open(readdirPath, 'w') as file:
+        file.write('[\n "a"\n]')
+    assert cache.readdir('/d') == None
+    assert cache.readdir_contains('/d', 'a') == None
+
+def test_listing_deleted_while_streaming(cache):
+    cache.readdir_save('/d', ['a', 'b'])
+    entries = cache.readdir('/d')
+    cache._deleteReaddir(cache._metadataPath('/d', metadata.Metadata.READDIR))
+    assert list(entries) == ['a', 'b']
@@ -0,0 +1,68 @@
+import errno
+import os
+
+import pytest
+
+try:
+    from sshfs_offline import trace
+except (ImportError, OSError):
+    pytest.skip('needs fusepy, libfuse and paramiko', allow_module_level=True)
+
+@pytest.fixture
+def calls(monkeypatch) -> list[tuple[str, str]]:
+    '''
+    The remote opens and listings.
+    '''
+    calls: list[tuple[str, str]] = []
+    for name in ('open', 'listdir'):
+        def call(self, path, *args, name=name, method=getattr(trace.SftpLocal, name)):
+            calls.append((name, path))
+            return method(self, path, *args)
+        monkeypatch.setattr(trace.SftpLocal, name, call)
+    return calls
+
+def remoteFile(remote: str, name: str, size: int) -> bytes:
+    buf = os.urandom(size)
+    with open(os.path.join(remote, name), 'wb') as file:
+        file.write(buf)
+    return buf
+
+def test_file(main, remote, calls):
+    buf = remoteFile(remote, 'a', 5000)
+    main.getattr('/a')
+    assert main.read('/a', 5000, 0, None) == buf
+    assert calls == [('open', 'a')]
+    calls.clear()
+    main.rename('/a', '/b')
+    assert main.read('/b', 5000, 0, None) == buf
+    assert main.getattr('/b')['st_size'] == 5000
+    assert calls == []
+    with pytest.raises(OSError) as e:
+        main.getattr('/a')
+    assert e.value.errno == errno.ENOENT
+
+def test_over_cached_file(main, remote, calls):
+    buf = remoteFile(remote, 'a', 5000)
+    remoteFile(remote, 'b', 3000)
+    main.read('/a', 5000, 0, None)
+    main.read('/b', 3000, 0, None)
+    calls.clear()
+    main.rename('/a', '/b')
+    assert main.read('/b', 5000, 0, None) == buf
+    assert calls == []
+
+def test_directory(main, remote, calls):
+    os.makedirs(os.path.join(remote, 'd', 'e'))
+    buf = remoteFile(remote, 'd/e/f', 5000)
+    assert list(main.readdir('/', None)) == ['.', '..', 'd']
+    assert list(main.readdir('/d/e', None)) == ['.', '..', 'f']
+    main.read('/d/e/f', 5000, 0, None)
+    calls.clear()
+    main.rename('/d', '/g')
+    assert list(main.readdir('/', None)) == ['.', '..', 'g']
+    assert list(main.readdir('/g/e', None)) == ['.', '..', 'f']
+    assert main.read('/g/e/f', 5000, 0, None) == buf
+    assert calls == []
+    with pytest.raises(OSError) as e:
+        main.getattr('/d/e/f')
+    assert e.value.errno == errno.ENOENT
@@ -0,0 +1,50 @@
+import io
+import os
+import stat
+
+import pytest
+
+try:
+    from sshfs_offline.cache import metadata
+    from sshfs_offline.cache import snapshot
+except (ImportError, OSError):
+    pytest.skip('needs fusepy, libfuse and paramiko', allow_module_level=True)
+
+def findEntry(fileType: str, mode: str, size: int, relPath: str, link: str='') -> bytes:
+    header = '{} {} {} 1000 100 1700000000.5 1700000001.25'.format(fileType, mode, size)
+    return '\0'.join([header, relPath, link]).encode('utf-8', 'surrogateescape') + b'\0'
+
+def test_parse_find(main, monkeypatch):
+    monkeypatch.setattr(snapshot.Snapshot, 'READ_SIZE', 7) # records split across reads
+    stdout = io.BytesIO(b''.join([
+        findEntry('f', '644', 5, 'sub/x'),
+        findEntry('l', '777', 1, 'sub/ln', 'x'),
+        findEntry('d', '755', 4096, 'sub'),
+        findEntry('f', '600', 0, 'we\nird'),
+        findEntry('D', '700', 4096, 'locked'),
+        findEntry('d', '755', 4096, ''),
+    ]))
+    assert snapshot.Snapshot()._parseFind('/a', stdout) == 6
+
+    assert list(metadata.cache.readdir('/a')) == ['locked', 'sub', 'we\nird']
+    assert list(metadata.cache.readdir('/a/sub')) == ['ln', 'x']
+    assert metadata.cache.readdir('/a/locked') == None
+    assert metadata.cache.readlink('/a/sub/ln') == 'x'
+    assert metadata.cache.getattr('/a/sub/x') == {
+        'st_atime': 1700000000, 'st_gid': 100, 'st_mode': stat.S_IFREG | 0o644, 'st_mtime': 1700000001, 'st_size': 5,
+        'st_uid': 1000}
+    assert metadata.cache.getattr('/a/sub/ln')['st_mode'] == stat.S_IFLNK | 0o777
+    assert metadata.cache.getattr('/a/locked')['st_mode'] == stat.S_IFDIR | 0o700
+
+def test_listdir(main, remote):
+    os.makedirs(os.path.join(remote, 'a', 'sub', 'deeper'))
+    with open(os.path.join(remote, 'a', 'sub', 'x'), 'wb') as file:
+        file.write(b'hello')
+    os.symlink('x', os.path.join(remote, 'a', 'sub', 'ln'))
+    snapshot.Snapshot().run('/a') # no SSH client, the tree is listed over SFTP
+
+    assert list(metadata.cache.readdir('/a')) == ['sub']
+    assert list(metadata.cache.readdir('/a/sub')) == ['deeper', 'ln', 'x']
+    assert list(metadata.cache.readdir('/a/sub/deeper')) == []
+    assert metadata.cache.readlink('/a/sub/ln') == 'x'
+    assert metadata.cache.getattr('/a/sub/x')['st_size'] == 5
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+try:
+    import fuse # fusepy raises OSError when libfuse is not installed
+    from sshfs_offline import trace
+except (ImportError, OSError):
+    pytest.skip('needs fusepy, libfuse and paramiko', allow_module_level=True)
+
+@pytest.fixture
+def args(args, tmp_path):
+    args.trace = str(tmp_path / 'trace')
+    return args
+
+def record(main, remote: str):
+    os.makedirs(os.path.join(remote, 'd', 'e'))
+    os.makedirs(os.path.join(remote, 'a'))
+    with open(os.path.join(remote, 'd', 'f'), 'wb') as file:
+        file.write(os.urandom(10000))
+    with open(os.path.join(remote, 'a', 'x'), 'wb') as file:
+        file.write(os.urandom(5000))
+
+    main('getattr', '/d/e') # only stat'ed
+    main('readdir', '/d', None)
+    main('getattr', '/d/f')
+    main('open', '/d/f', fuse.fuse_file_info())
+    main('read', '/d/f', 4096, 8192, None)
+    main('mkdir', '/d/sub', 0o755)
+    main('getattr', '/d/sub')
+    main('rmdir', '/d/sub')
+    main('symlink', '/d/l', 'f')
+    main('readlink', '/d/l')
+    main('getattr', '/d/l')
+    main('create', '/d/n', 0o644, fuse.fuse_file_info())
+    main('write', '/d/n', b'abc', 0, None)
+    main('rename', '/d/n', '/d/m')
+    main('truncate', '/d/m', 1)
+    main('unlink', '/d/m')
+    main('rename', '/a', '/b')
+    main('read', '/b/x', 4096, 4096, None)
+    main.tracer.close()
+
+def test_read(main, remote, args):
+    record(main, remote)
+    options, ops = trace.readTrace(args.trace)
+    ops = list(ops)
+    assert options['remotedir'] == '/base'
+    assert [op.op for op in ops][:3] == ['getattr', 'readdir', 'getattr']
+    assert all(op.errno == 0 for op in ops)
+    assert ops[0].fileType == trace.TYPE_DIR
+    assert ops[2].fileType == trace.TYPE_FILE
+    assert ops[10].fileType == trace.TYPE_LINK
+    assert (ops[13].path, ops[13].path2) == ('/d/n', '/d/m')
+    assert (ops[4].offset, ops[4].size) == (8192, 4096)
+
+def test_truncated(main, remote, args):
+    record(main, remote)
+    with open(args.trace, 'rb+') as file:
+        file.truncate(os.path.getsize(args.trace) - 5)
+    options, ops = trace.readTrace(args.trace)
+    assert len(list(ops)) == 17
+
+def test_synthesize(main, remote, args, tmp_path):
+    record(main, remote)
+    options, ops = trace.readTrace(args.trace)
+    synthesized = str(tmp_path / 'synthesized')
+    trace.synthesize(list(ops), synthesized)
+    assert os.path.isdir(os.path.join(synthesized, 'd', 'e'))
+    assert os.path.getsize(os.path.join(synthesized, 'd', 'f')) == 12288
+    assert os.path.getsize(os.path.join(synthesized, 'a', 'x')) == 8192
+    for path in ['d/sub', 'd/l', 'd/n', 'd/m', 'b']:
+        assert not os.path.lexists(os.path.join(synthesized, path)), path
+
+@pytest.mark.parametrize('serial', [True, False])
+def test_replay(main, remote, args, serial):
+    record(main, remote)
+    replay = trace.Replay(args.trace, serial=serial)
+    try:
+        result = replay.run()
+    finally:
+        replay.close()
+    assert result['total']['count'] == 18
+    assert result['total']['errors'] == 0, result['ops']